@@ -0,0 +1,100 @@
+"""
+Benchmark of MongoBulkWriter with different numbers of writers, against an in-process stand-in for the
+collection. Every bulk operation waits --latency seconds, like the round trip to a real server, and
+--fail-rate of the documents fail in their first try, to exercise the retries of the failed documents.
+
+    python benchmarks/bench_bulk_writer.py --rows 100000 --batch-size 1000 --writers 1 2 4 8
+
+mongomock is too slow for these sizes (it scans the collection on every upsert), so the stand-in keeps the
+documents in a dict and only implements the ReplaceOne upserts the writer sends.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+from pymongo.errors import BulkWriteError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+from bench_create_list_dict_upload import synthetic_frame
+
+
+class BulkWriteResult:
+    def __init__(self, upserted_count, modified_count, matched_count):
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+        self.matched_count = matched_count
+
+
+class StandInCollection:
+    """
+    Collection of documents by '_id' whose bulk operations take latency seconds and where each document
+    fails with probability fail_rate the first time it is written.
+    """
+    def __init__(self, latency, fail_rate):
+        self.documents = {}
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.failed_once = set()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def bulk_write(self, operations, ordered=True):
+        # The round trip runs in parallel, the writes themselves one at a time like in a single server.
+        time.sleep(self.latency)
+        upserted = modified = matched = 0
+        write_errors = []
+        with self.lock:
+            for i, operation in enumerate(operations):
+                key = repr(operation._filter['_id'])
+                if key not in self.failed_once and self.random.random() < self.fail_rate:
+                    self.failed_once.add(key)
+                    write_errors.append({'index':i, 'code':91, 'errmsg':'simulated failure'})
+                    continue
+                if key in self.documents:
+                    matched += 1
+                    modified += self.documents[key] != operation._doc
+                else:
+                    upserted += 1
+                self.documents[key] = operation._doc
+        if write_errors:
+            raise BulkWriteError({'nUpserted':upserted, 'nModified':modified, 'nMatched':matched, 'writeErrors':write_errors})
+        return BulkWriteResult(upserted, modified, matched)
+
+
+class MockMongoClient:
+    # Same interface as MongoDB.OurMongoClient: the pymongo client is in the 'client' attribute.
+    def __init__(self, collection):
+        self.client = {'gestao':{'bbg.company_financials':collection}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--fail-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    documents = gfd.create_list_dict_upload(synthetic_frame(args.rows))
+    for n_writers in args.writers:
+        collection = StandInCollection(args.latency, args.fail_rate)
+        connection = gfd.MongoConnection(client_factory=lambda environment: MockMongoClient(collection))
+        time_zero = time.perf_counter()
+        with gfd.MongoBulkWriter(connection, n_writers=n_writers, batch_size=args.batch_size, write_concern={'w':1}) as writer:
+            counts = writer.write(iter(documents))
+        seconds = time.perf_counter() - time_zero
+        assert counts['failed'] == 0
+        assert len(collection.documents) == counts['upserted'] and counts['upserted'] + counts['matched'] == len(documents)
+        print(f'{n_writers:>3d} writers  {seconds:7.2f}s  {len(documents) / seconds:>9.0f} docs/s  {counts}')
+
+
+if __name__ == '__main__':
+    main()
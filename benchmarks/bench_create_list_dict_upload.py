@@ -0,0 +1,79 @@
+"""
+Microbenchmark of create_list_dict_upload against the previous iterrows implementation.
+
+    python benchmarks/bench_create_list_dict_upload.py --rows 1000000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+
+
+def create_list_dict_upload_iterrows(df):
+    # Implementation that used df.iterrows(), kept here as the reference.
+    df['value'] = df['value'].round(6)
+    list_dict_upload = []
+    for idx, row in df.iterrows():
+        dict_i = {
+            '_id':{
+                'date':row['date'],
+                'bbg_ticker':row['ID'],
+                'measure':row['measure'],
+                'source':row['source'],
+                'period':row['period'],
+                'actual_or_estimate':row['actual_or_estimate'],
+                'revision_date':row['revision_date'],
+                'currency':row['currency']
+            },
+            'value':row['value']
+        }
+        list_dict_upload.append(dict_i)
+    return list_dict_upload
+
+
+def synthetic_frame(n_rows, seed=0)->pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    tickers = np.array([f'TCK{i:04d} BZ Equity' for i in range(2000)])
+    brokers = np.array([f'Broker {i}' for i in range(40)])
+    dates = pd.to_datetime(['2025-03-31','2025-06-30','2025-09-30','2025-12-31','2026-12-31'])
+    return pd.DataFrame({
+        'ID':tickers[rng.integers(0, len(tickers), n_rows)],
+        'period':rng.choice(['A','Q'], n_rows),
+        'source':brokers[rng.integers(0, len(brokers), n_rows)],
+        'revision_date':pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D'),
+        'currency':rng.choice(['BRL','USD'], n_rows),
+        'value':rng.normal(100, 50, n_rows),
+        'measure':'IS_EPS',
+        'actual_or_estimate':'E',
+        'date':dates[rng.integers(0, len(dates), n_rows)],
+    })
+
+
+def timed(func, df):
+    time_zero = time.perf_counter()
+    result = func(df.copy())
+    return result, time.perf_counter() - time_zero
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = synthetic_frame(args.rows)
+    new, new_seconds = timed(gfd.create_list_dict_upload, df)
+    old, old_seconds = timed(create_list_dict_upload_iterrows, df)
+    assert new == old, 'create_list_dict_upload output differs from the iterrows implementation'
+    print(f'rows: {args.rows}')
+    print(f'iterrows:  {old_seconds:.2f}s')
+    print(f'columnar:  {new_seconds:.2f}s ({old_seconds / new_seconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the memory and the concat time of the dataframes of financials with the dtypes of
+FINANCIALS_SCHEMA (categoricals, datetime64, float64) against the same dataframes with object columns,
+as they were before the schema. Also checks that both give the same documents.
+
+    python benchmarks/bench_financials_schema.py --tickers 1000 --brokers 20
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+from run_benchmarks import FIELDS, MEASURES, synthetic_bql_response
+
+
+def financials_frames(n_tickers, n_brokers, tickers_per_request)->list:
+    """
+    Creates the dataframes main() uploads for the estimates of the MEASURES, one per measure and request.
+    """
+    tickers = [f'TCK{i:05d} BZ Equity' for i in range(n_tickers)]
+    batch = [(measure, type_period) for measure in MEASURES for type_period in ['A','Q']]
+    list_dfs = []
+    for seed, tickers_request in enumerate(gfd.iter_chunks(tickers, tickers_per_request)):
+        request = gfd.create_batch_request('2025-01-01','2027-12-31',batch,tickers_request,'BROKERS_ALL','E',FIELDS)
+        df = synthetic_bql_response(request, n_brokers, seed)
+        list_dfs.extend(gfd.process_batch_response(df,batch,'BROKERS_ALL','E',len(FIELDS)).values())
+    return list_dfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, default=1000)
+    parser.add_argument('--brokers', type=int, default=20)
+    parser.add_argument('--tickers-per-request', type=int, default=200)
+    args = parser.parse_args()
+    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+
+    list_dfs = financials_frames(args.tickers, args.brokers, args.tickers_per_request)
+    object_columns = {col:object for col, dtype in gfd.FINANCIALS_SCHEMA.items() if dtype == 'category'}
+    list_dfs_object = [df.astype(object_columns) for df in list_dfs]
+
+    time_zero = time.perf_counter()
+    df_object = pd.concat(list_dfs_object)
+    object_seconds = time.perf_counter() - time_zero
+    time_zero = time.perf_counter()
+    df_schema = gfd.concat_financials(list_dfs)
+    schema_seconds = time.perf_counter() - time_zero
+
+    assert all(df_schema[col].dtype == 'category' for col in object_columns)
+    sample = slice(0, 50000)
+    assert gfd.create_list_dict_upload(df_object.iloc[sample].copy()) == gfd.create_list_dict_upload(df_schema.iloc[sample].copy())
+
+    object_mb = df_object.memory_usage(deep=True).sum() / 1024**2
+    schema_mb = df_schema.memory_usage(deep=True).sum() / 1024**2
+    print(f'{len(list_dfs)} dataframes, {len(df_schema)} rows')
+    print(f'object columns : {object_mb:9.1f} MB  concat {object_seconds:7.3f}s')
+    print(f'schema         : {schema_mb:9.1f} MB  concat {schema_seconds:7.3f}s')
+    print(f'schema / object : memory {schema_mb / object_mb:.2f}x, concat time {schema_seconds / object_seconds:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
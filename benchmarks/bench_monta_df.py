@@ -0,0 +1,115 @@
+"""
+Benchmark of monta_df for the BROKERS_ALL source against the previous implementation, that used a
+pivot table and one dataframe per ticker, from 100 to 5,000 tickers.
+
+    python benchmarks/bench_monta_df.py --tickers 100 500 1000 5000 --brokers 30
+
+The output is always checked first against fixtures/monta_df_brokers_all.pkl, a small (df_value, df_source)
+pair in the layout of a BROKERS_ALL response with uneven broker counts, values without a source, a NaN
+source and a ticker missing from df_source. Pass --fixture to also check another recorded pair saved
+with pandas.to_pickle.
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'monta_df_brokers_all.pkl')
+
+
+def monta_df_brokers_all_pivot(df_value,df_source,source,bql_function,quarter_or_annual,actual_or_estimate):
+    # Implementation of the BROKERS_ALL path that used a pivot table, kept here as the reference.
+    if df_value.empty or df_source.empty:
+        return pd.DataFrame()
+    df_source = df_source.reset_index()
+    if df_value[df_value.columns[1]].isna().all() or df_source[df_source.columns[1]].isna().all():
+        return pd.DataFrame()
+    df_source.rename(columns = {df_source.columns[0]:'ticker',df_source.columns[1]:'source'}, inplace=True)
+    df_source = df_source.reset_index()
+    df_source.rename(columns={'index': 'idx'}, inplace=True)
+    df_pivot_source = pd.pivot_table(df_source,index=['idx'], columns=['ticker'], values=['source'], aggfunc='first')
+    list_dfs = []
+    for col in df_pivot_source.columns:
+        df_col = df_pivot_source[col]
+        df_col = df_col.dropna()
+        df_col = df_col.reset_index()
+        df_col = df_col.drop(columns = 'idx')
+        df_col.columns = df_col.columns.droplevel(0)
+        list_dfs.append(df_col)
+    df_source = pd.concat(list_dfs, axis=1)
+    df_source = df_source.reset_index(drop=True)
+    df_value.rename(columns = {df_value.columns[0]:'date'}, inplace = True)
+    df_value = df_value.iloc[1:]
+    df_value = df_value.reset_index(drop = True)
+    df_value = df_value.rename(columns = {'DATE_VALUE':'date'})
+    list_dfs = []
+    for col in df_source.columns:
+        df_concat_i = pd.concat([df_value[['date',col]] , df_source[[col]]] , axis = 1)
+        df_concat_i['ticker'] = col
+        df_concat_i.columns = ['date','VALUE', 'SOURCE', 'ticker']
+        df_concat_i['period'] = quarter_or_annual
+        df_concat_i['actual_or_estimate'] = actual_or_estimate
+        df_concat_i['function'] = bql_function
+        df_concat_i = df_concat_i.dropna(subset = 'VALUE')
+        list_dfs.append(df_concat_i)
+    return pd.concat(list_dfs,axis=0)
+
+
+def synthetic_inputs(n_tickers, n_brokers, seed=0):
+    """
+    Creates a (df_value, df_source) pair like the BROKERS_ALL response: df_value has a header row and
+    one column per ticker with a value per broker, df_source has the broker of each value indexed by ticker.
+    """
+    rng = np.random.default_rng(seed)
+    tickers = [f'TCK{i:05d} BZ Equity' for i in range(n_tickers)]
+    brokers = np.array([f'Broker {i}' for i in range(n_brokers)])
+    n_brokers_ticker = rng.integers(1, n_brokers + 1, n_tickers)
+    values = rng.normal(100, 50, (n_brokers, n_tickers))
+    values[np.arange(n_brokers)[:, None] >= n_brokers_ticker[None, :]] = np.nan
+    values[rng.random(values.shape) < 0.05] = np.nan
+    df_value = pd.DataFrame(values, columns=tickers)
+    df_value.insert(0, 'DATE_VALUE', pd.Timestamp('2025-12-31'))
+    df_value = pd.concat([pd.DataFrame([{'DATE_VALUE':'DATE_VALUE'}]), df_value], ignore_index=True)
+    ticker_index = np.repeat(tickers, n_brokers_ticker)
+    sources = np.concatenate([rng.choice(brokers, k, replace=False) for k in n_brokers_ticker])
+    df_source = pd.DataFrame({'SOURCE':sources}, index=pd.Index(ticker_index, name='ID'))
+    return df_value, df_source
+
+
+def timed(func, df_value, df_source):
+    params = ('BROKERS_ALL','IS_EPS','Q','E')
+    time_zero = time.perf_counter()
+    result = func(df_value.copy(), df_source.copy(), *params)
+    return result, time.perf_counter() - time_zero
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tickers', type=int, nargs='+', default=[100, 500, 1000, 5000])
+    parser.add_argument('--brokers', type=int, default=30)
+    parser.add_argument('--fixture', help='pickle with a recorded (df_value, df_source) tuple')
+    args = parser.parse_args()
+    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+
+    inputs = [('fixture', pd.read_pickle(FIXTURE_PATH))]
+    if args.fixture:
+        inputs.append((os.path.basename(args.fixture), pd.read_pickle(args.fixture)))
+    for n_tickers in args.tickers:
+        inputs.append((f'{n_tickers} tickers', synthetic_inputs(n_tickers, args.brokers)))
+
+    for name, (df_value, df_source) in inputs:
+        new, new_seconds = timed(gfd.monta_df, df_value, df_source)
+        old, old_seconds = timed(monta_df_brokers_all_pivot, df_value, df_source)
+        pd.testing.assert_frame_equal(new, old)
+        print(f'{name:>15s}  pivot: {old_seconds:7.2f}s  vectorized: {new_seconds:6.3f}s  ({old_seconds / new_seconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
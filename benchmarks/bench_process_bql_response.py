@@ -0,0 +1,91 @@
+"""
+Benchmark of the post-processing of BQL responses (process_bql_response) against the previous
+implementation that used apply for period_to_date and fill_source_if_actual.
+
+    python benchmarks/bench_process_bql_response.py --rows 200000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+
+
+def process_bql_response_apply(df,bbg_function,source,type_period,e_or_a):
+    # Implementation that used apply row by row, kept here as the reference.
+    df = df.drop_duplicates()
+    for i in range(len(df.columns)-1):
+        df = df.rename(columns = {df.columns[i+1]:df.columns[i+1].split('.')[-1].lower()})
+    df = df.dropna(subset = 'value')
+    df = df.dropna(subset = 'period')
+    df['revision_date'] = df['revision_date'].astype(str)
+    df['revision_date'] = df['revision_date'].str.replace('NaT','1900-01-01')
+    df['revision_date'] = pd.to_datetime(df['revision_date'])
+    df['measure'] = bbg_function
+    df['actual_or_estimate'] = e_or_a
+    df['date'] = df['period']
+    df['date'] = df['date'].apply(lambda row: gfd.period_to_date(row))
+    df['period'] = type_period
+    df = df.rename(columns = {'firm_name':'source'})
+    if source == "BST":
+        df['source'] = 'bst_estimate'
+    else:
+        df['source'] = df.apply(gfd.fill_source_if_actual, axis =1)
+    if not 'currency' in df.columns:
+        df['currency'] = 'N/A'
+    return df
+
+
+def synthetic_response(n_rows, type_period='Q', seed=0)->pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    functions = gfd.create_bql_functions_list('IS_EPS','BROKERS_ALL','2025-01-01','2027-12-31',type_period,'E',
+                                              ['PERIOD','FIRM_NAME','REVISION_DATE','CURRENCY','VALUE'])
+    if type_period == 'Q':
+        periods = [f'{year} Q{q}' for year in (2025, 2026, 2027) for q in (1, 2, 3, 4)]
+    else:
+        periods = ['2025 A', '2026 A', '2027 A']
+    revision_dates = pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+    revision_dates = revision_dates.where(rng.random(n_rows) > 0.05)
+    values = rng.normal(100, 50, n_rows)
+    values[rng.random(n_rows) < 0.05] = np.nan
+    return pd.DataFrame({
+        'ID':np.array([f'TCK{i:04d} BZ Equity' for i in range(2000)])[rng.integers(0, 2000, n_rows)],
+        functions[0]:np.array(periods)[rng.integers(0, len(periods), n_rows)],
+        functions[1]:np.array([f'Broker {i}' for i in range(40)])[rng.integers(0, 40, n_rows)],
+        functions[2]:revision_dates,
+        functions[3]:rng.choice(['BRL','USD'], n_rows),
+        functions[4]:values,
+    })
+
+
+def timed(func, *args):
+    time_zero = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - time_zero
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200_000)
+    args = parser.parse_args()
+
+    for type_period in ('Q', 'A'):
+        df = synthetic_response(args.rows, type_period)
+        params = ('IS_EPS','BROKERS_ALL',type_period,'E')
+        new, new_seconds = timed(gfd.process_bql_response, df.copy(), *params)
+        old, old_seconds = timed(process_bql_response_apply, df.copy(), *params)
+        # The reference predates FINANCIALS_SCHEMA, so it is compared after getting the same dtypes.
+        assert gfd.has_financials_schema(new)
+        pd.testing.assert_frame_equal(new, gfd.apply_financials_schema(old))
+        print(f'rows: {args.rows} period: {type_period}')
+        print(f'apply:      {old_seconds:.2f}s')
+        print(f'vectorized: {new_seconds:.2f}s ({old_seconds / new_seconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures the peak RSS of fetching, converting and uploading a single BQL request of N tickers, reading the
+whole response at once or in blocks of rows (main(stream_block_rows=...)). The response is generated a few
+tickers at a time, like the rows read from the sheet, and the documents are built and chunked as they would
+be for the upload but not sent anywhere, so only the memory of the pipeline itself is measured.
+
+    python benchmarks/bench_streaming_memory.py --tickers 500 2000 5000 --brokers 10 --block-rows 50000
+
+Each measurement runs in its own forked process, since the peak RSS of a process never goes down.
+"""
+import os
+import sys
+import argparse
+import resource
+import multiprocessing
+import warnings
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+from run_benchmarks import FIELDS, MEASURES, synthetic_bql_response
+
+
+class SyntheticSheetBackend(gfd.FakeBackend):
+    # Generates the response a few tickers at a time, so the source of the rows doesn't hold the whole response.
+    def __init__(self, n_brokers):
+        super().__init__(lambda request: synthetic_bql_response(request, n_brokers))
+        self.n_brokers = n_brokers
+
+    def _iter_response(self, request, block_rows):
+        rows_per_ticker = len(synthetic_bql_response(gfd.BQLRequest(request.tickers[:1], request.functions), self.n_brokers))
+        for seed, tickers in enumerate(gfd.iter_chunks(request.tickers, max(1, block_rows // rows_per_ticker))):
+            yield synthetic_bql_response(gfd.BQLRequest(tickers, request.functions), self.n_brokers, seed)
+
+    def collect(self, handle)->pd.DataFrame:
+        return pd.concat(self._iter_response(handle['request'], 50000), ignore_index=True)
+
+    def collect_blocks(self, handle, block_rows):
+        yield from self._iter_response(handle['request'], block_rows)
+
+
+def peak_rss_mb()->float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(n_tickers, n_brokers, block_rows, results):
+    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+    baseline = peak_rss_mb()
+    tickers = [f'TCK{i:05d} BZ Equity' for i in range(n_tickers)]
+    batch = [(measure, 'Q') for measure in MEASURES]
+    request = gfd.create_batch_request('2025-01-01','2027-12-31',batch,tickers,'BROKERS_ALL','E',FIELDS)
+    n_documents = [0]
+
+    def build_documents(list_dfs):
+        for df in list_dfs:
+            for chunk in gfd.iter_chunks(gfd.iter_dict_upload(df), 1000):
+                n_documents[0] += len(chunk)
+        return True
+
+    scheduler = gfd.BQLScheduler(SyntheticSheetBackend(n_brokers), block_rows=block_rows)
+    with gfd.UploadPipeline(max_queue=8, upload_func=build_documents) as pipeline:
+        for job_id, df, error in scheduler.run([('job', request)]):
+            blocks = [df] if block_rows is None else df
+            for df_block, is_last in gfd.iter_last(blocks):
+                dict_dfs = gfd.process_batch_response(df_block,batch,'BROKERS_ALL','E',len(FIELDS))
+                for (func, _), df_func in dict_dfs.items():
+                    pipeline.put(func, df_func, complete=is_last)
+    results.put((n_documents[0], baseline, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, nargs='+', default=[500, 2000, 5000])
+    parser.add_argument('--brokers', type=int, default=10)
+    parser.add_argument('--block-rows', type=int, default=50000)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    for n_tickers in args.tickers:
+        for mode, block_rows in [('whole', None), ('stream', args.block_rows)]:
+            results = context.Queue()
+            process = context.Process(target=run, args=(n_tickers, args.brokers, block_rows, results))
+            process.start()
+            n_documents, baseline, peak = results.get()
+            process.join()
+            print(f'{n_tickers:>6d} tickers  {mode:6s}  documents: {n_documents:>9d}  '
+                  f'peak RSS: {peak:8.1f} MB  (+{peak - baseline:.1f} MB over the start)')
+
+
+if __name__ == '__main__':
+    main()
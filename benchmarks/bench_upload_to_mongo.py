@@ -0,0 +1,113 @@
+"""
+Benchmark of the uploads to MongoDB with a connection per chunk against a single MongoConnection
+for the whole upload, using mongomock as an in-process stand-in for the database. The uploads go
+through MongoBulkWriter (as in main), which only needs pymongo and not the internal mongo library.
+
+    python benchmarks/bench_upload_to_mongo.py --rows 1000 --chunk 50 --connect-latency 0.05
+
+mongomock looks up upserts by scanning the collection, so keep the number of rows small.
+
+It also checks the path upload_dfs falls back to without a writer (upload_to_mongo chunk by chunk with a
+shared connection, opened again after a ConnectionFailure), with mongo.bulk_update stubbed since the
+internal mongo library isn't available outside the office machines.
+"""
+import os
+import sys
+import time
+import types
+import argparse
+
+import mongomock
+from pymongo.errors import ConnectionFailure
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+from bench_create_list_dict_upload import synthetic_frame
+
+
+class MockMongoClient:
+    # Same interface as MongoDB.OurMongoClient: the pymongo client is in the 'client' attribute.
+    def __init__(self, client):
+        self.client = client
+
+
+def mock_client_factory(server, connect_latency, counter):
+    def factory(environment):
+        # Simulating the TCP/TLS/auth handshake of a real connection.
+        time.sleep(connect_latency)
+        counter['connections'] += 1
+        return MockMongoClient(server)
+    return factory
+
+
+def check_upload_to_mongo_fallback(rows):
+    """
+    Uploads the documents of a dataframe with upload_dfs and no writer, with a mongo.bulk_update stub that
+    loses the connection on the first chunk, and checks that the other chunks are uploaded through a new one.
+    """
+    df = synthetic_frame(rows)
+    n_documents = len(gfd.create_list_dict_upload(df))
+    assert n_documents > 1000, 'upload_dfs uploads chunks of 1000 documents, the check needs more than one.'
+    stored = {}
+    calls = {'n':0}
+    def bulk_update(collection, list_dict_upload):
+        calls['n'] += 1
+        if calls['n'] == 1:
+            raise ConnectionFailure('connection lost')
+        for doc in list_dict_upload:
+            stored[repr(sorted(doc['_id'].items()))] = doc
+    internal_libs = gfd.MongoDB, gfd.mongo
+    # Both set, so load_internal_libs doesn't try to import the real ones.
+    gfd.MongoDB, gfd.mongo = types.SimpleNamespace(), types.SimpleNamespace(bulk_update=bulk_update)
+    try:
+        counter = {'connections':0}
+        with gfd.MongoConnection(client_factory=mock_client_factory(mongomock.MongoClient(), 0, counter)) as connection:
+            uploaded = gfd.upload_dfs([df], connection=connection)
+            assert not uploaded and counter['connections'] == 2
+            assert len(stored) == n_documents - 1000
+            # Uploading again once the connection is back.
+            assert gfd.upload_dfs([df], connection=connection)
+            assert len(stored) == n_documents and counter['connections'] == 2
+    finally:
+        gfd.MongoDB, gfd.mongo = internal_libs
+    print(f'upload_to_mongo fallback: {n_documents} documents, connection opened again after a ConnectionFailure')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--chunk', type=int, default=50)
+    parser.add_argument('--connect-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    list_dict_upload = gfd.create_list_dict_upload(synthetic_frame(args.rows))
+    chunks = gfd.separa_lista(list_dict_upload, args.chunk)
+
+    results = {}
+    for mode in ('per_chunk', 'shared'):
+        server = mongomock.MongoClient()
+        counter = {'connections':0}
+        factory = mock_client_factory(server, args.connect_latency, counter)
+        time_zero = time.perf_counter()
+        if mode == 'per_chunk':
+            list_counts = []
+            for chunk in chunks:
+                with gfd.MongoConnection(client_factory=factory) as connection, \
+                        gfd.MongoBulkWriter(connection, n_writers=1, batch_size=args.chunk) as writer:
+                    list_counts.append(writer.write(chunk))
+        else:
+            with gfd.MongoConnection(client_factory=factory) as connection, \
+                    gfd.MongoBulkWriter(connection, n_writers=1, batch_size=args.chunk) as writer:
+                list_counts = [writer.write(list_dict_upload)]
+        seconds = time.perf_counter() - time_zero
+        assert all(counts['failed'] == 0 for counts in list_counts)
+        assert server['gestao']['bbg.company_financials'].count_documents({}) > 0
+        results[mode] = (seconds, counter['connections'])
+        print(f'{mode:10s} chunks: {len(chunks)} connections: {counter["connections"]} time: {seconds:.2f}s')
+
+    print(f'speedup: {results["per_chunk"][0] / results["shared"][0]:.1f}x')
+    check_upload_to_mongo_fallback(max(args.rows, 1500))
+
+
+if __name__ == '__main__':
+    main()
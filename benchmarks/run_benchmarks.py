@@ -0,0 +1,156 @@
+"""
+Offline benchmark of the company financials pipeline, without a bloomberg terminal or the production
+MongoDB. Synthetic BQL responses for N tickers x M brokers x periods go through a FakeBackend, the
+get_df post-processing, monta_df, create_list_dict_upload and a MongoBulkWriter upload to mongomock,
+reporting the throughput and the peak memory of every stage at several scales.
+
+    python benchmarks/run_benchmarks.py --tickers 100 1000 5000 --brokers 20 --output bench.json
+    python benchmarks/run_benchmarks.py --output new.json --compare bench.json
+
+The data is generated with fixed seeds so results are comparable between commits.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import mongomock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_fundamentalist_data4 as gfd
+from bench_monta_df import synthetic_inputs
+
+FIELDS = ['PERIOD','FIRM_NAME','REVISION_DATE','CURRENCY','VALUE']
+MEASURES = ['IS_EPS','SALES_REV_TURN','EBITDA','GROSS_PROFIT']
+
+
+def synthetic_bql_response(request, n_brokers, seed=0)->pd.DataFrame:
+    """
+    Creates the raw response excel would return for a (possibly batched) BQL request: an 'ID' column
+    and one column per function, with a row per ticker, broker and period of every measure.
+    """
+    rng = np.random.default_rng(seed)
+    n_fields = len(FIELDS)
+    brokers = np.array([f'Broker {i}' for i in range(n_brokers)])
+    parts = []
+    for i in range(0, len(request.functions), n_fields):
+        functions = request.functions[i:i + n_fields]
+        start_year = int(re.search(r"start='(\d{4})", functions[0]).group(1))
+        end_year = int(re.search(r"end='(\d{4})", functions[0]).group(1))
+        years = range(start_year, end_year + 1)
+        if "FPT='Q'" in functions[0]:
+            periods = [f'{year} Q{q}' for year in years for q in (1, 2, 3, 4)]
+        else:
+            periods = [f'{year} A' for year in years]
+        n_rows = len(request.tickers) * n_brokers * len(periods)
+        parts.append(pd.DataFrame({
+            'ID':np.repeat(request.tickers, n_brokers * len(periods)),
+            functions[0]:np.tile(periods, len(request.tickers) * n_brokers),
+            functions[1]:np.tile(np.repeat(brokers, len(periods)), len(request.tickers)),
+            functions[2]:pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D'),
+            functions[3]:rng.choice(['BRL','USD'], n_rows),
+            functions[4]:rng.normal(100, 50, n_rows),
+        }))
+    return pd.concat(parts, ignore_index=True)[['ID'] + request.functions]
+
+
+def measure(func, *args):
+    """
+    Runs func and returns (result, seconds, peak memory in MB).
+    """
+    tracemalloc.start()
+    time_zero = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - time_zero
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1024**2
+
+
+class MockMongoClient:
+    # Same interface as MongoDB.OurMongoClient: the pymongo client is in the 'client' attribute.
+    def __init__(self, client):
+        self.client = client
+
+
+def run_scale(n_tickers, n_brokers, upload_docs):
+    tickers = [f'TCK{i:05d} BZ Equity' for i in range(n_tickers)]
+    batches = gfd.plan_bql_batches(MEASURES, ['A','Q'], len(FIELDS))
+    backend = gfd.FakeBackend(lambda request: synthetic_bql_response(request, n_brokers))
+    results = {}
+
+    def fetch_and_process():
+        list_dfs = []
+        for batch in batches:
+            dict_dfs = gfd.get_batch_dfs('2025-01-01','2027-12-31',batch,tickers,'BROKERS_ALL','E',FIELDS,backend=backend)
+            list_dfs.extend(dict_dfs.values())
+        return gfd.concat_financials(list_dfs)
+    df, seconds, peak = measure(fetch_and_process)
+    results['get_df_postprocessing'] = (len(df), seconds, peak)
+
+    df_value, df_source = synthetic_inputs(n_tickers, n_brokers)
+    df_monta, seconds, peak = measure(gfd.monta_df, df_value, df_source, 'BROKERS_ALL', 'IS_EPS', 'Q', 'E')
+    results['monta_df'] = (len(df_monta), seconds, peak)
+
+    list_dict_upload, seconds, peak = measure(gfd.create_list_dict_upload, df)
+    results['create_list_dict_upload'] = (len(list_dict_upload), seconds, peak)
+
+    # mongomock looks up every upsert scanning the collection, so only part of the documents is uploaded.
+    docs = list_dict_upload[:upload_docs]
+    server = mongomock.MongoClient()
+    connection = gfd.MongoConnection(client_factory=lambda environment: MockMongoClient(server))
+    def upload():
+        # The writer main() uploads with, it only needs pymongo (not the internal mongo library).
+        with gfd.MongoBulkWriter(connection, n_writers=1, batch_size=1000, write_concern={'w':1}) as writer:
+            return writer.write(docs)
+    counts, seconds, peak = measure(upload)
+    assert counts['failed'] == 0
+    results['mongo_bulk_writer'] = (len(docs), seconds, peak)
+
+    return {stage:{'rows':rows, 'seconds':round(seconds, 4), 'rows_per_second':round(rows / seconds, 1) if seconds else None,
+                   'peak_mb':round(peak, 2)}
+            for stage, (rows, seconds, peak) in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--brokers', type=int, default=20)
+    parser.add_argument('--upload-docs', type=int, default=1000, help='documents uploaded to mongomock at each scale')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+
+    report = {'python':platform.python_version(), 'pandas':pd.__version__, 'brokers':args.brokers, 'scales':{}}
+    for n_tickers in args.tickers:
+        report['scales'][str(n_tickers)] = run_scale(n_tickers, args.brokers, args.upload_docs)
+        for stage, result in report['scales'][str(n_tickers)].items():
+            print(f"{n_tickers:>6d} tickers  {stage:25s} rows: {result['rows']:>9d}  {result['seconds']:8.3f}s  "
+                  f"{result['rows_per_second'] or 0:>12.0f} rows/s  peak: {result['peak_mb']:8.1f} MB")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print('\nChange against', args.compare)
+        for scale, stages in report['scales'].items():
+            for stage, result in stages.items():
+                old = previous.get('scales', {}).get(scale, {}).get(stage)
+                if old and old['seconds']:
+                    print(f"{scale:>6s} tickers  {stage:25s} time: {result['seconds'] / old['seconds'] - 1:+7.1%}  "
+                          f"peak: {result['peak_mb'] / old['peak_mb'] - 1 if old['peak_mb'] else 0:+7.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
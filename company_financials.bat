@@ -6,8 +6,8 @@ set CURRENT_DIR=%~dp0
 REM Activate the Conda environment
 call activate pyQuant_3_11
 
-REM Run the Python script
-python "%CURRENT_DIR%\get_fundamentalist_data4.py"
+REM Run the Python script, passing on the arguments (e.g. run --measures IS_EPS --tickers "VALE3 BZ Equity")
+python "%CURRENT_DIR%\get_fundamentalist_data4.py" %*
 
-REM Pause the script to keep the window open
-pause
\ No newline at end of file
+REM Returning the exit code of the script, so a scheduled task can see if it failed
+exit /b %ERRORLEVEL%
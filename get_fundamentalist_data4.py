@@ -1,26 +1,166 @@
 # 1. Importing libraries
 import sys
 import os
-user = os.getlogin()
-sys.path.append()
-sys.path.append()
-
-import MongoDB
-import mongo
 import pandas as pd
+from pandas.api.types import union_categoricals
 import datetime
 from dateutil.relativedelta import relativedelta
-import xlwings as xw
 import time
 import subprocess
 from tqdm import tqdm
 import warnings
 import traceback
 import numpy as np
+import hashlib
+import re
+import json
+import queue
+import threading
+import argparse
+import contextlib
+import functools
+import itertools
+import concurrent.futures
+try:
+    from pymongo import ReplaceOne, WriteConcern
+    from pymongo.errors import BulkWriteError, ConnectionFailure as MongoConnectionFailure
+except ImportError:
+    ReplaceOne = WriteConcern = None
+    BulkWriteError = MongoConnectionFailure = ()
+# The internal libraries (MongoDB, mongo) and xlwings are only imported when they are first needed, see
+# load_internal_libs and load_xlwings. The dry run and the benchmarks start faster and run without them.
+MongoDB = None
+mongo = None
+xw = None
 
 
 # 2. Defining functions
 
+def load_internal_libs():
+    """
+    Imports the internal libraries used to connect and upload to MongoDB (MongoDB and mongo).
+    """
+    global MongoDB, mongo
+    if MongoDB is None or mongo is None:
+        user = os.getlogin()
+        sys.path.append()
+        sys.path.append()
+        import MongoDB
+        import mongo
+
+def load_xlwings():
+    """
+    Imports xlwings, that only exists on the Windows machines with Excel and the Bloomberg add-in.
+    Without it the replay backend can still be used to run the rest of the pipeline.
+    """
+    global xw
+    if xw is None:
+        try:
+            import xlwings as xw
+        except ImportError:
+            raise ImportError('xlwings is required to run BQL requests through excel.') from None
+    return xw
+
+class RunMetrics:
+    """
+    Records how long every stage of the run takes (workbook setup, bloomberg wait, sheet read,
+    post-processing, monta_df, document building, uploads), with the number of rows and retries,
+    and writes a report with percentiles at the end of the run.
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, **labels):
+        with self.lock:
+            self.records.append({'stage':stage, 'seconds':seconds, **labels})
+
+    @contextlib.contextmanager
+    def stage(self, stage, **labels):
+        """
+        Times the code inside the with block. The yielded dict can receive more labels (e.g. 'rows').
+        """
+        labels = dict(labels)
+        time_zero = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.record(stage, time.perf_counter() - time_zero, **labels)
+
+    def summary(self)->pd.DataFrame:
+        """
+        Returns a dataframe with count, total, percentiles and rows of every stage.
+        """
+        with self.lock:
+            df = pd.DataFrame(self.records)
+        if df.empty:
+            return pd.DataFrame()
+        for col in ('rows', 'retries'):
+            if col not in df.columns:
+                df[col] = np.nan
+        grouped = df.groupby('stage')
+        df_summary = grouped['seconds'].agg(['count','sum','mean','max'])
+        for q in (0.5, 0.9, 0.95, 0.99):
+            df_summary[f'p{int(q*100)}'] = grouped['seconds'].quantile(q)
+        df_summary['rows'] = grouped['rows'].sum()
+        df_summary['retries'] = grouped['retries'].sum()
+        return df_summary
+
+    def write_report(self, directory, prometheus_path=None)->str:
+        """
+        Writes the report of the run (JSON with the summary and CSV with every record) in the directory,
+        and optionally the summary in the Prometheus text format. Returns the path of the JSON report.
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = datetime.datetime.now().strftime('run_report_%Y%m%d_%H%M%S')
+        df_summary = self.summary()
+        json_path = os.path.join(directory, f'{name}.json')
+        with open(json_path, 'w') as f:
+            json.dump({'created':datetime.datetime.now().isoformat(),
+                       'stages':json.loads(df_summary.to_json(orient='index'))}, f, indent=2)
+        with self.lock:
+            pd.DataFrame(self.records).to_csv(os.path.join(directory, f'{name}.csv'), index=False)
+        if prometheus_path is not None:
+            self.write_prometheus(prometheus_path, df_summary)
+        return json_path
+
+    def write_prometheus(self, path, df_summary=None):
+        if df_summary is None:
+            df_summary = self.summary()
+        lines = ['# HELP bbg_financials_stage_seconds Duration of the stages of the company financials run.',
+                 '# TYPE bbg_financials_stage_seconds summary']
+        for stage, row in df_summary.iterrows():
+            for q in (0.5, 0.9, 0.95, 0.99):
+                lines.append(f'bbg_financials_stage_seconds{{stage="{stage}",quantile="{q}"}} {row[f"p{int(q*100)}"]}')
+            lines.append(f'bbg_financials_stage_seconds_sum{{stage="{stage}"}} {row["sum"]}')
+            lines.append(f'bbg_financials_stage_seconds_count{{stage="{stage}"}} {int(row["count"])}')
+        lines.append('# HELP bbg_financials_stage_rows Rows processed by the stages of the company financials run.')
+        lines.append('# TYPE bbg_financials_stage_rows gauge')
+        for stage, row in df_summary.iterrows():
+            lines.append(f'bbg_financials_stage_rows{{stage="{stage}"}} {row["rows"]}')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+# Metrics of the current run, shared by every stage.
+run_metrics = RunMetrics()
+
+def timed_stage(stage):
+    """
+    Decorator that records the time of every call of the function as a stage in run_metrics, with
+    the number of rows of the dataframe or list it returns.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with run_metrics.stage(stage) as labels:
+                result = func(*args, **kwargs)
+                if isinstance(result, (pd.DataFrame, list)):
+                    labels['rows'] = len(result)
+                return result
+        return wrapper
+    return decorator
+
 def get_tickers_from_bd(mdb)->list:
     """
     This function gets the list of equity bloomberg tickers that are in use.
@@ -37,12 +177,85 @@ def get_tickers_from_bd(mdb)->list:
         List of bloomberg equity tickers that are in use in our context.
     """
     list_tickers = []
-    collection = mdb.client['gestao']['asset.metadata'].find({'type':'equity','in_use':True})
+    # Only the bloomberg ticker is read from the documents.
+    collection = mdb.client['gestao']['asset.metadata'].find({'type':'equity','in_use':True}, {'ticker.bbg':1, '_id':0})
     for doc in collection:
         list_tickers.append(doc['ticker']['bbg'])
     return list_tickers
 
 
+class TickerUniverse:
+    """
+    Keeps on disk the list of equity tickers in use, so it is only read again from 'asset.metadata' when
+    it is older than ttl_seconds or when the change token of the collection (number of equities in use and
+    the largest _id among them) is different. It also keeps the tickers that were already backfilled, so
+    the tickers added since the previous run can be requested on their own.
+
+    Parameters:
+    ----------
+    path : str
+        JSON file where the universe is stored.
+    ttl_seconds : float
+        Time after which the tickers are read again even if the change token is the same.
+    """
+    query = {'type':'equity','in_use':True}
+
+    def __init__(self, path='ticker_universe.json', ttl_seconds=24*3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def change_token(self, collection)->str:
+        last = list(collection.find(self.query, {'_id':1}).sort('_id', -1).limit(1))
+        return f"{collection.count_documents(self.query)}|{last[0]['_id'] if last else None}"
+
+    def tickers(self, mdb)->list:
+        """
+        Returns the sorted list of equity tickers in use, from the local copy if it is still valid.
+
+        Parameters:
+        ----------
+        mdb : atmlib.mongo.OurMongoClient
+            Instance of the MongoDB client, see MongoConnection.open.
+        """
+        collection = mdb.client['gestao']['asset.metadata']
+        token = self.change_token(collection)
+        fetched_at = self.state.get('fetched_at')
+        is_fresh = fetched_at is not None and time.time() - fetched_at < self.ttl_seconds
+        if not (is_fresh and self.state.get('token') == token):
+            self.state['tickers'] = sorted(get_tickers_from_bd(mdb))
+            self.state['token'] = token
+            self.state['fetched_at'] = time.time()
+        if 'known' not in self.state:
+            # In the first run there is nothing to compare with, every ticker follows the normal schedule.
+            self.state['known'] = list(self.state['tickers'])
+        return list(self.state['tickers'])
+
+    def diff(self)->tuple:
+        """
+        Returns (added, removed): the tickers in use that weren't backfilled yet and the backfilled tickers
+        that are not in use anymore. Call tickers first.
+        """
+        tickers, known = set(self.state['tickers']), set(self.state['known'])
+        return sorted(tickers - known), sorted(known - tickers)
+
+    def mark_backfilled(self, tickers):
+        """
+        Records that the tickers were backfilled and forgets the ones that are not in use anymore.
+        """
+        in_use = set(self.state['tickers'])
+        self.state['known'] = sorted((set(self.state['known']) | set(tickers)) & in_use)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
 def create_bql_function(bql_function:str, source:str, start_date:str, end_date:str, quarter_or_anual:str, actual_or_estimate:str, flds:str )->str:
 
     """
@@ -98,6 +311,7 @@ def create_bql_request(tickers_range,functions_range)-> str:
 
 
 
+@timed_stage('monta_df')
 def monta_df(df_value,df_source,source,bql_function,quarter_or_annual,actual_or_estimate)->pd.DataFrame:
     """
     This function creates a consolidated pandas dataframe from another dataframe with the values gathered
@@ -130,20 +344,11 @@ def monta_df(df_value,df_source,source,bql_function,quarter_or_annual,actual_or_
         df_source = df_source.reset_index()
         if df_value[df_value.columns[1]].isna().all() or df_source[df_source.columns[1]].isna().all():
             return pd.DataFrame()
-        df_source.rename(columns = {df_source.columns[0]:'ticker',df_source.columns[1]:'source'}, inplace=True)
-        df_source = df_source.reset_index()
-        df_source.rename(columns={'index': 'idx'}, inplace=True)
-        df_pivot_source = pd.pivot_table(df_source,index=['idx'], columns=['ticker'], values=['source'], aggfunc='first')
-        list_dfs = []
-        for col in df_pivot_source.columns:
-            df_col = df_pivot_source[col]
-            df_col = df_col.dropna()
-            df_col = df_col.reset_index()
-            df_col = df_col.drop(columns = 'idx')
-            df_col.columns = df_col.columns.droplevel(0)
-            list_dfs.append(df_col)
-        df_source = pd.concat(list_dfs, axis=1)
-        df_source = df_source.reset_index(drop=True)
+        df_source = df_source.iloc[:, :2]
+        df_source.columns = ['ticker','SOURCE']
+        # The n-th source of a ticker goes with the n-th value of the ticker's column in df_value.
+        df_source = df_source.dropna(subset = 'SOURCE')
+        df_source['pos'] = df_source.groupby('ticker').cumcount()
         df_value.rename(columns = {df_value.columns[0]:'date'}, inplace = True)
         df_value = df_value.iloc[1:]
         df_value = df_value.reset_index(drop = True)
@@ -152,21 +357,26 @@ def monta_df(df_value,df_source,source,bql_function,quarter_or_annual,actual_or_
         #    df_value['date'] = pd.to_datetime(df_value['date'])
         #except:
         #    return pd.DataFrame()
-        list_dfs = []
-        for col in df_source.columns:
-            #print(col)
-            df_concat_i = pd.concat([df_value[['date',col]] , df_source[[col]]] , axis = 1)
-            df_concat_i['ticker'] = col 
-            col_value = str('VALUE')
-            col_source = str('SOURCE')
-            df_concat_i.columns = ['date',col_value, col_source, 'ticker']
-            df_concat_i['period'] = quarter_or_annual
-            df_concat_i['actual_or_estimate'] = actual_or_estimate
-            df_concat_i['function'] = bql_function
-            df_concat_i = df_concat_i.dropna(subset = col_value)
-            #dict_dfs[col] = df_concat_i
-            list_dfs.append(df_concat_i)
-        df = pd.concat(list_dfs,axis=0)
+        # Turning the grid of values (one column per ticker) into a long dataframe in a single step
+        # and attaching the sources by ticker and position.
+        tickers = sorted(df_source['ticker'].unique())
+        n_rows = len(df_value)
+        dates = df_value['date'].to_numpy()
+        values = df_value[tickers].to_numpy()
+        # Passing the dtypes so pandas doesn't try to infer other ones from object columns.
+        df = pd.DataFrame({
+            'date':pd.Series(np.tile(dates, len(tickers)), dtype = dates.dtype),
+            'VALUE':pd.Series(values.ravel(order = 'F'), dtype = values.dtype),
+            'ticker':pd.Series(np.repeat(np.array(tickers, dtype = object), n_rows), dtype = object),
+            'pos':np.tile(np.arange(n_rows), len(tickers)),
+        })
+        df = df.dropna(subset = 'VALUE')
+        df = df.merge(df_source, on = ['ticker','pos'], how = 'left')
+        df.index = df['pos'].to_numpy()
+        df = df[['date','VALUE','SOURCE','ticker']]
+        df['period'] = quarter_or_annual
+        df['actual_or_estimate'] = actual_or_estimate
+        df['function'] = bql_function
 
         return df
     
@@ -229,10 +439,15 @@ def fill_source_if_actual(row)->str:
     
     return row['source']
 
+# Values the BQL cell shows when the add-in is not working (e.g. the BQL formula is not loaded).
+BQL_ADDIN_FAILURE_VALUES = ('#NAME?',)
+
 def verify_BQL_request(cell)-> bool:
     """
     This function verifies if the BQL request on excel has been completed.
     If it is, it returns True, if it isn't it returns False.
+    If the cell shows an error instead of the data it raises an exception, so the
+    error isn't taken as a finished request.
     
     Parameters:
     ----------
@@ -243,319 +458,2787 @@ def verify_BQL_request(cell)-> bool:
     bool:
         Returns True or False.
     """
-    if cell.value == '#N/A Requesting Data...':
+    value = cell.value
+    if value == '#N/A Requesting Data...':
         return False
-    else:
-        return True
+    if isinstance(value, str) and value in BQL_ADDIN_FAILURE_VALUES:
+        raise BQLAddinError(f'BQL add-in failed with {value}')
+    if isinstance(value, str) and value.startswith('#'):
+        raise BQLRequestError(f'BQL request failed with {value}')
+    return True
     
 
-def get_df(start,end,bbg_function,tickers,source,type_period,e_or_a,fields):
+def create_bql_functions_list(bbg_function,source,start,end,type_period,e_or_a,fields)->list:
     """
-    This function creates a dataframe with a friendly format based on the response of the BQL query on excel.
+    This function creates the list of BQL functions (one for each field) that will be pasted into excel.
 
     Parameters:
     ----------
+    bbg_function : str
+        Bloomberg function used in the bloomberg terminal or BQL queries to get companies financials.
+    source : str
+        Source parameters that is passed to the bloomberg function.
     start : str
         The start date in string format (yyyy-mm-dd).
     end : str
         The end date in string format (yyyy-mm-dd).
-    bbg_function : str
-        Bloomberg function used in the bloomberg terminal or BQL queries to get companies financials.
-    tickers : list
-        List of tickers used to get financials of.
-    source : str
-        Source parameters that is passed to the bloomberg function. It defines from what vendors the data will come from. 
     type_period : str
         Type of financial period you have interest in getting. 'Q' for quarter, 'A' for annual.
     e_or_a : str
         Defines if the value will is an estimate ('E') or the actual realized value ('A').
     fields : list
-        List of fields that will be retrived from each fuction passed to the BQL query.
-    
+        List of fields that will be retrived from the function.
+
     Returns:
     -------
-    df : pandas.DataFrame
-        Returns a pandas dataframe with a friendly format.
+    list :
+        List of BQL functions strings.
     """
-    # If "A" (representing actual values) is passed then there is no need to look for the future.
-    if e_or_a == 'A':
-        end = datetime.datetime.today().strftime('%Y-%m-%d')
-
-    # Creating workbook intance with xlwings
-    wb = xw.Book()
-    sht = wb.sheets[0]
-    sht.activate()
-
-    # Getting the length of the ticker list being passed in this python function,
-    # so that when we paste the ticker and bbg_functions into excel we know exactly the range where
-    # it beggings and ends
-    init_row = 3
-    tickers_len = len(tickers)
-    final_range_tickers = init_row + tickers_len - 1
-    range_tickers = f'$A${init_row}:$A${final_range_tickers}'
-    
-    # Pasting the bloomberg tickers we want data from.
-    sht.range(f'A{init_row}').options(transpose=True).value = [tickers]
-    time.sleep(0.5)
-
-    # Calling the fuction that creates the bbg_fuctions_str for the BQL query
     list_bql_func = []
     for fld in fields:
         bql_function_str = create_bql_function(bbg_function,source,start,end,type_period,e_or_a,fld)
         list_bql_func.append(bql_function_str)
-    # Pasting the bloomberg fuctions we want data from. 
-    sht.range('B3').options(transpose=True).value = list_bql_func
-    fields_len = len(fields)
-    range_bql_func = f"B3:B{fields_len+2}"
-    time.sleep(0.5)
-
-    # Creating the BQL query with the functions already pasted.
-    bql_query = create_bql_request(range_tickers,range_bql_func)
-    # Pasting the query into an excel cell.
-    sht.range('E3').formula = bql_query
-
-    minutes_retry = 5
-    # Checking every 3s if the BQL request has finished.
-    # And if it takes more than 5 minutes it closes excel and tries again.
-    time_zero = datetime.datetime.today()
-    request_done = False
-    while not request_done:
-        request_done = verify_BQL_request(sht.range('E3'))
-        time.sleep(3)
-        time_now = datetime.datetime.today()
-        delta_time = time_now - time_zero
-        delta_time = delta_time.total_seconds()/60 # in minutes
-        if delta_time > minutes_retry and request_done == False:
-            time_zero = datetime.datetime.today()
-            wb.close()
-            time.sleep(60)
-            wb = xw.Book()
-            sht = wb.sheets[0]
-            sht.activate()
-            sht.range(f'A{init_row}').options(transpose=True).value = [tickers]
-            time.sleep(0.5)
-            list_bql_func = []
-            for fld in fields:
-                bql_function_str = create_bql_function(bbg_function,source,start,end,type_period,e_or_a,fld)
-                list_bql_func.append(bql_function_str)
-            sht.range('B3').options(transpose=True).value = list_bql_func
-            # Creating the BQL query.
-            bql_query = create_bql_request(range_tickers,range_bql_func)
-            # Pasting the query into an excel cell.
-            sht.range('E3').formula = bql_query
-
-    time.sleep(1)
-
-    # Changing the format of date cells.
-    sht.range('F3').expand('down').number_format = 'yyyy-mm-dd'
-    # Getting the data retrived from the BQL query into a dataframe.
-    df = sht.range('E3').expand('right').expand('down').options(pd.DataFrame, index=False, header=True).value
-    # Closing the excel workbook
-    wb.close()
-    time.sleep(2)
+    return list_bql_func
 
-    df = df.drop_duplicates()
-    for i in range(len(df.columns)-1):
-        df = df.rename(columns = {df.columns[i+1]:df.columns[i+1].split('.')[-1].lower()})
-        #df = df.rename(columns = {df.columns[i+1]:fields[i].lower()})
-    
-    
-    df = df.dropna(subset = 'value')
-    df = df.dropna(subset = 'period')
 
-    # For some reason fillna wasn't working for the NaT in 'revision_date' so I did a workaround
-    df['revision_date'] = df['revision_date'].astype(str)
-    df['revision_date'] = df['revision_date'].str.replace('NaT','1900-01-01')
-    df['revision_date'] = pd.to_datetime(df['revision_date'])
-    df['measure'] = bbg_function
-    df['actual_or_estimate'] = e_or_a
-    df['date'] = df['period']
-    df['date'] = df['date'].apply(lambda row: period_to_date(row))
-    df['period'] = type_period
-    df = df.rename(columns = {'firm_name':'source'})
-    if source == "BST":
-        df['source'] = 'bst_estimate'
-    else:
-        df['source'] = df.apply(fill_source_if_actual, axis =1)
-    
-    if not 'currency' in df.columns:
-        df['currency'] = 'N/A'
+# Matches the period window of the BQL functions built by create_bql_function.
+BQL_WINDOW_PATTERN = re.compile(r"FPR=range\(start='[^']*',end='[^']*'\)")
 
-    return df
 
-def create_list_dict_upload(df):
+class BQLRequest:
     """
-    This function creates a list of dictionaries in a BSON format to later upload to MongoDB
+    A BQL request: the tickers and the BQL functions that are TEXTJOINed into a single query.
 
     Parameters:
     ----------
-    df : pandas.DataFrame()
-        A panda dataframe with columns : date , ID , measure , source , period , 
-        actual_or_estimate , revision_date , currency , value.
-    
-    Returns:
-    -------
-    list_dict_upload : list[dict]
-        Returns a list of dictionaries in BSON format for later upload to MongoDB.
+    tickers : list
+        List of bloomberg tickers.
+    functions : list
+        List of BQL functions strings (see create_bql_function).
     """
-    # Making sure values don't take too much memory needlessly
-    df['value'] = df['value'].round(6)
-    # Creating a list with dictionaries.
-    list_dict_upload = []
-    for idx, row in df.iterrows():
-        dict_i = {
-            '_id':{
-                'date':row['date'],
-                'bbg_ticker':row['ID'],
-                'measure':row['measure'],
-                'source':row['source'],
-                'period':row['period'],
-                'actual_or_estimate':row['actual_or_estimate'],
-                'revision_date':row['revision_date'],
-                'currency':row['currency']
-            },
-            'value':row['value']
-        }
-        list_dict_upload.append(dict_i)
-    return list_dict_upload
+    def __init__(self, tickers, functions):
+        self.tickers = list(tickers)
+        self.functions = list(functions)
+
+    def key(self)->str:
+        """
+        Returns a hash that identifies the request, used to store and find recorded responses.
+        """
+        payload = json.dumps({'tickers':self.tickers,'functions':self.functions}, sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def replay_key(self)->str:
+        """
+        Returns a hash of the request without the dates of the FPR window, so a response recorded on one
+        day can be replayed on another (the window of the anual requests ends today and the backfill
+        windows depend on the year). It still identifies the tickers, measures, source, FPT and AE.
+        """
+        functions = [BQL_WINDOW_PATTERN.sub('FPR=range()', function) for function in self.functions]
+        payload = json.dumps({'tickers':self.tickers,'functions':functions}, sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def to_dict(self)->dict:
+        return {'tickers':self.tickers,'functions':self.functions}
 
-def upload_to_mongo(list_dict_upload):
+
+class BQLBackend:
     """
-    This function uploads a list of documents to mongoDB.
+    Interface of the objects that run a BQL request and return the raw response as a dataframe,
+    with the same layout excel returns from the BQL formula cell (an 'ID' column and one column per function).
+
+    Backends that can only block implement fetch. The submit/poll/collect methods let a BQLScheduler
+    keep several requests in flight; by default they just call fetch.
+    """
+    def fetch(self, request)->pd.DataFrame:
+        raise NotImplementedError
+
+    def submit(self, request):
+        """
+        Starts a request and returns a handle to it.
+        """
+        return {'request':request, 'df':self.fetch(request)}
+
+    def poll(self, handle)->bool:
+        """
+        Returns True if the request of the handle has finished.
+        """
+        return True
+
+    def collect(self, handle)->pd.DataFrame:
+        """
+        Returns the response of a finished request and frees its resources.
+        """
+        return handle['df']
+
+    def collect_blocks(self, handle, block_rows):
+        """
+        Yields the response of a finished request in dataframes of at most block_rows rows (at least one,
+        even if the response is empty) and frees its resources once they were all read.
+        """
+        df = self.collect(handle)
+        for i in range(0, max(len(df), 1), block_rows):
+            yield df.iloc[i:i + block_rows]
+
+    def is_cached(self, handle)->bool:
+        """
+        Returns True if the request of the handle was answered without asking bloomberg (e.g. from a cache),
+        so its time says nothing about how long bloomberg takes.
+        """
+        return False
+
+    def cancel(self, handle):
+        """
+        Gives up on a request that has not finished.
+        """
+        pass
+
+    def recover(self):
+        """
+        Called after the backend failed, so it can get back to a working state.
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncBQLBackend(BQLBackend):
+    """
+    Base of the backends that run requests without blocking. They implement submit, poll and collect,
+    and fetch waits for the request checking it every poll_seconds.
+    """
+    poll_seconds = 3
+
+    def fetch(self, request)->pd.DataFrame:
+        handle = self.submit(request)
+        while not self.poll(handle):
+            time.sleep(self.poll_seconds)
+        return self.collect(handle)
+
+    def submit(self, request):
+        raise NotImplementedError
+
+    def poll(self, handle)->bool:
+        raise NotImplementedError
+
+    def collect(self, handle)->pd.DataFrame:
+        raise NotImplementedError
+
+
+class BQLAddinError(Exception):
+    """
+    Raised when the Bloomberg add-in fails in excel and the request could not be completed.
+    """
+
+
+class BQLStaleRequestError(Exception):
+    """
+    Raised for a request that was running in a workbook that has since been restarted (because of a
+    failure of another request). Nothing is wrong with the request itself, it is just sent again.
+    """
+
+
+class BQLTimeoutError(Exception):
+    """
+    Raised when a BQL request takes longer than allowed.
+    """
+
+
+class BQLRequestError(Exception):
+    """
+    Raised when bloomberg answers a BQL request with an error (e.g. '#N/A Invalid Parameter').
+    Trying the same request again won't help, so it is not retried.
+    """
+
+
+class RequestLatencyHistory:
+    """
+    Keeps the time the BQL requests took to finish and uses it to decide how often to check if a request
+    has finished (exponential backoff) and when to give up on it (a multiple of a percentile of the
+    observed times, instead of a fixed number of minutes).
 
     Parameters:
-    -----------
-    list_dict_upload : list
-        List of dictionaries in a format to facilitate upload to mongoDB.
+    ----------
+    path : str
+        JSON file where the history is kept between runs. If None the history only lives in memory.
+    percentile : float
+        Percentile of the observed times used to set the timeout.
+    timeout_factor : float
+        The timeout is the percentile multiplied by this factor.
+    default_timeout : float
+        Timeout in seconds used while there are less than min_samples observations.
+    min_timeout : float
+        The timeout is never lower than this, in seconds.
+    min_samples : int
+        Number of observations needed before the percentile is used.
+    first_poll : float
+        Seconds before the first check of a request.
+    max_poll : float
+        Maximum seconds between two checks of a request.
+    backoff : float
+        Factor the time between checks grows after each check.
+    max_history : int
+        Number of observations kept for each key.
+    """
+    def __init__(self, path=None, percentile=95, timeout_factor=3.0, default_timeout=300, min_timeout=60,
+                 min_samples=20, first_poll=0.25, max_poll=5.0, backoff=1.5, max_history=500):
+        self.path = path
+        self.percentile = percentile
+        self.timeout_factor = timeout_factor
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.first_poll = first_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.max_history = max_history
+        self.history = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.history = json.load(f)
+
+    def record(self, seconds, key=None):
+        """
+        Stores the time a request took. The observation is kept both for its key and for all requests.
+        """
+        for k in {'all', str(key) if key is not None else 'all'}:
+            list_seconds = self.history.setdefault(k, [])
+            list_seconds.append(round(seconds, 3))
+            del list_seconds[:-self.max_history]
+
+    def timeout_seconds(self, key=None)->float:
+        """
+        Returns the time after which a request is considered stuck.
+        """
+        list_seconds = self.history.get(str(key) if key is not None else 'all', [])
+        if len(list_seconds) < self.min_samples:
+            list_seconds = self.history.get('all', [])
+        if len(list_seconds) < self.min_samples:
+            return self.default_timeout
+        return max(self.min_timeout, float(np.percentile(list_seconds, self.percentile)) * self.timeout_factor)
+
+    def next_poll_seconds(self, previous=None)->float:
+        """
+        Returns the time to wait before checking a request again, given the previous wait.
+        """
+        if previous is None:
+            return self.first_poll
+        return min(self.max_poll, previous * self.backoff)
+
+    def summary(self)->dict:
+        """
+        Returns the percentiles of the observed times for every key.
+        """
+        return {
+            k:{'count':len(v), 'p50':float(np.percentile(v, 50)), 'p95':float(np.percentile(v, 95)),
+               'timeout':self.timeout_seconds(None if k == 'all' else k)}
+            for k, v in self.history.items() if v
+        }
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump(self.history, f)
+
+
+EXCEL_PATH = "C:\\Program Files\\Microsoft Office\\root\\Office16\\EXCEL.EXE"
+
+def launch_excel(excel_path=EXCEL_PATH):
+    """
+    This function opens an excel instance for the add-ins to load, unless excel is already open.
+    It doesn't wait for excel to start, see wait_excel_ready.
 
     Returns:
-    --------
-    True or False : Boolean
-        Returns True if the upload was successful and False if it wasn't.
+    -------
+    subprocess.Popen or None :
+        Returns the excel process, or None if excel was already open.
     """
-    # Creating a mongoDB connection
-    tipo_bd = 'PROD'
-    mdb = MongoDB.OurMongoClient(MongoDB.get_mongo_conn(environment=tipo_bd))
-    # Storing the collection where the data will be stored
-    financials_collection = mdb.client['gestao']['bbg.company_financials']
-    # Uploading the list of dictionaries we created.
+    if load_xlwings().apps.count > 0:
+        return None
+    return subprocess.Popen([excel_path])
+
+def excel_is_ready()->bool:
+    """
+    Returns True if excel is open and ready to receive commands, and the Bloomberg add-in (if it is one
+    of the COM add-ins of excel) is connected.
+    """
+    xw = load_xlwings()
     try:
-        mongo.bulk_update(financials_collection,list_dict_upload)
-        mdb.client.close()
-        #print('Script was successful!')
+        if xw.apps.count == 0 or not xw.apps.active.api.Ready:
+            return False
+        addins = xw.apps.active.api.COMAddIns
+        for i in range(1, addins.Count + 1):
+            addin = addins.Item(i)
+            if 'bloomberg' in str(addin.Description).lower() and not addin.Connect:
+                return False
         return True
-    except Exception as e:
-        traceback.print_exc()
-        print(e)
-        mdb.client.close()
-        print("Error: Couldn't upload to DataBase.")
+    except Exception:
+        # Excel refuses COM calls while it is starting.
         return False
-    
-def period_to_date(period):
-    year = int(period.split()[0])
-    if 'A' in period:
-        date = datetime.datetime(year,12,31)
-    if 'Q' in period:
-        quarter = int(period.split()[-1][-1:])
-        month = quarter*3
-        date = datetime.datetime(year,month,1)
-        date = date + relativedelta(day = 31)
 
-    return date
+def wait_excel_ready(timeout=120, poll_seconds=0.5):
+    """
+    This function waits until excel is ready (see excel_is_ready) instead of waiting a fixed time.
 
-def main():
+    Parameters:
+    ----------
+    timeout : float
+        Maximum number of seconds to wait.
+    poll_seconds : float
+        Time between the checks.
+    """
+    time_zero = time.monotonic()
+    with run_metrics.stage('excel_startup'):
+        while not excel_is_ready():
+            if time.monotonic() - time_zero > timeout:
+                raise TimeoutError(f'Excel was not ready after {timeout}s.')
+            time.sleep(poll_seconds)
 
-    # Supressing warnings
-    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
-    warnings.simplefilter(action ='ignore', category = FutureWarning)
 
-    # Opening an excel instance for the addins to load.
-    excel_path = "C:\\Program Files\\Microsoft Office\\root\\Office16\\EXCEL.EXE"
-    subprocess.Popen([excel_path])
-    time.sleep(15)
+class ExcelSession:
+    """
+    Owns a single excel workbook that is reused by every BQL request, instead of creating and closing
+    a workbook for each one. The workbook is only closed and opened again when the add-in fails.
 
-    # Creating a connection to our mongoDB database.
-    tipo_bd = 'PROD'
-    mdb = MongoDB.OurMongoClient(MongoDB.get_mongo_conn(environment=tipo_bd))
+    Parameters:
+    ----------
+    book_factory : callable
+        Function that creates the workbook. Defaults to xlwings.Book, it can be replaced by a fake
+        workbook to measure the session without excel.
+    """
+    def __init__(self, book_factory=None):
+        self.book_factory = book_factory
+        self.wb = None
+        # Incremented every time the workbook is replaced, so requests started in an old one can be detected.
+        self.generation = 0
+        # Counters to measure how the session is being used.
+        self.workbooks_opened = 0
+        self.restarts = 0
+        self.requests_run = 0
 
-    # Getting a list of equity tickers from mongoDB.
-    list_tickers = get_tickers_from_bd(mdb)
-    # Closing mongoDb connection.
-    mdb.client.close()
-    # Sorting the list in alphabetical order.
-    list_tickers = sorted(list_tickers)
+    def open(self):
+        if self.book_factory is None:
+            self.book_factory = load_xlwings().Book
+        with run_metrics.stage('workbook_setup'):
+            self.wb = self.book_factory()
+        self.workbooks_opened += 1
+        self.generation += 1
 
-    # Creating a place where the user can pass how many tickers they want
-    # the script to run with, for test purposes.
-    #list_tickers_slice = separa_lista(list_tickers,60)
-    list_tickers_slice = [list_tickers]
+    def sheet(self, index=0):
+        """
+        Returns a sheet of the session workbook, opening the workbook and adding sheets if needed.
+        """
+        if self.wb is None:
+            self.open()
+        while len(self.wb.sheets) <= index:
+            self.wb.sheets.add(after=self.wb.sheets[-1])
+        return self.wb.sheets[index]
 
-    # Passing the periodicity variables that will be used in fuctions in the loop.
-    periods = ['A','Q']
-    # Passing the type of value variables that will be used in fuctions in the loop.
-    actual_or_estimate = ['E','A']
-    # Passing the BLQ fuctions that will be used for the BQLs queries in the loop.
-    bql_functions = ['IS_EPS','IS_COMP_EPS_ADJUSTED','SALES_REV_TURN',
-                    'IS_COMP_SALES','EBITDA','IS_COMPARABLE_EBITDA',
-                    'IS_COMPARABLE_EBIT','CF_CAP_EXPEND_PRPTY_ADD','IS_OPER_INC',
-                    'IS_OPERATING_EXPN','IS_TOT_OPER_EXP','GROSS_PROFIT',
-                    'CB_IS_ADJUSTED_OPEX','IS_AVG_NUM_SH_FOR_EPS','IS_SH_FOR_DILUTED_EPS',
-                    'CF_FREE_CASH_FLOW']
-    bql_functions = bql_functions[:]
-    # Passing the kind of source we want the script to get.
-    #sources = ['BROKERS_ALL','BST','cmpy'] Defined it inside the loop using ifs statements
-    # Passing time variables from which we want data from.
-    years_lagging = 1
-    start = f'{datetime.datetime.today().year + years_lagging}-01-01'
-    years_ahead = 2
-    end = f'{datetime.datetime.today().year + years_ahead}-12-31'
-    # Passing fields variables from with we want the values from. 
-    flds = ['PERIOD','FIRM_NAME','REVISION_DATE','CURRENCY','VALUE']
-    
-    # Creating a dictionary to store if we successfully uploaded every function to MongoDB.
-    already_uploaded = {}
-    for tickers in list_tickers_slice: # Use this loop if there are so many tickers that it is best to divide them
-        for func in tqdm(bql_functions):
-            list_dfs = []
-            for e_or_a in actual_or_estimate:
-                if e_or_a == 'E':
-                    sources = ['BROKERS_ALL','BST','cmpy','cmpy_low','cmpy_high']
-                else: # if e_or_a == 'A'
-                    sources = ['cmpy']
-                for source in sources:
-                    for type_period in periods:
-                        df = get_df(start,end,func,tickers,source,type_period, e_or_a, flds)
-                        list_dfs.append(df)
-            df_concat = pd.concat(list_dfs)
-            list_dict_upload = create_list_dict_upload(df_concat)
-            # Separating the list to upload to lists with a maximum of 1000 documents.
-            list_of_list_dict_upload = separa_lista(list_dict_upload,1000)
-            list_was_uploaded = []
-            for list_upload in list_of_list_dict_upload:
-                was_uploaded = upload_to_mongo(list_upload)
-                list_was_uploaded.append(was_uploaded)
-            if all(list_was_uploaded):
-                already_uploaded[func] = [True]
-            else:
-                already_uploaded[func] = [False]
-    
-    print(pd.DataFrame(already_uploaded))
-    
+    def clear(self, index=0):
+        """
+        Clears the contents of a sheet so it can be used by the next request.
+        """
+        self.sheet(index).clear_contents()
 
-            
+    def restart(self):
+        """
+        Closes the workbook and opens a new one. Used when the add-in fails.
+        """
+        self.close()
+        self.open()
+        self.restarts += 1
+
+    def close(self):
+        if self.wb is not None:
+            try:
+                self.wb.close()
+            except Exception:
+                # The workbook may already be gone if excel crashed.
+                traceback.print_exc()
+            self.wb = None
+
+
+class XlwingsBackend(AsyncBQLBackend):
+    """
+    Runs the BQL requests in excel through xlwings, using the Bloomberg add-in.
+    Every request reuses the workbook of the same ExcelSession, each request in flight using its own sheet.
+
+    Parameters:
+    ----------
+    session : ExcelSession
+        Session that owns the workbook. A new one is created if None.
+    max_restarts : int
+        Maximum number of times excel is restarted for the same request when the add-in fails.
+    latency_history : RequestLatencyHistory
+        History of the request times, used by fetch to decide how often to check the request and when
+        to paste it again.
+    """
+    init_row = 3
+
+    def __init__(self, session=None, max_restarts=3, latency_history=None):
+        self.session = session if session is not None else ExcelSession()
+        self.max_restarts = max_restarts
+        self.latency_history = latency_history if latency_history is not None else RequestLatencyHistory()
+        self.busy_sheets = set()
+
+    def _paste_request(self, sht, request):
+        # Getting the length of the ticker list being passed,
+        # so that when we paste the ticker and bbg_functions into excel we know exactly the range where
+        # it beggings and ends
+        final_range_tickers = self.init_row + len(request.tickers) - 1
+        range_tickers = f'$A${self.init_row}:$A${final_range_tickers}'
+        # Pasting the bloomberg tickers we want data from.
+        sht.range(f'A{self.init_row}').options(transpose=True).value = [request.tickers]
+        # Pasting the bloomberg fuctions we want data from.
+        sht.range('B3').options(transpose=True).value = request.functions
+        range_bql_func = f"B3:B{len(request.functions)+2}"
+        # Creating the BQL query with the functions already pasted.
+        bql_query = create_bql_request(range_tickers,range_bql_func)
+        # Pasting the query into an excel cell.
+        sht.range('E3').formula = bql_query
+        return bql_query
+
+    def _sheet(self, handle):
+        if handle['generation'] != self.session.generation:
+            raise BQLStaleRequestError('The workbook of the request was restarted.')
+        return self.session.sheet(handle['sheet'])
+
+    def _release(self, handle):
+        # After a restart the sheet numbers belong to the requests of the new workbook.
+        if handle['generation'] == self.session.generation:
+            self.busy_sheets.discard(handle['sheet'])
+
+    def submit(self, request):
+        index = 0
+        while index in self.busy_sheets:
+            index += 1
+        self.session.clear(index)
+        sht = self.session.sheet(index)
+        self.busy_sheets.add(index)
+        bql_query = self._paste_request(sht, request)
+        return {'request':request, 'sheet':index, 'query':bql_query, 'generation':self.session.generation}
+
+    def poll(self, handle)->bool:
+        return verify_BQL_request(self._sheet(handle).range('E3'))
+
+    def collect(self, handle)->pd.DataFrame:
+        sht = self._sheet(handle)
+        with run_metrics.stage('sheet_read') as labels:
+            # Changing the format of date cells.
+            sht.range('F3').expand('down').number_format = 'yyyy-mm-dd'
+            # Getting the data retrived from the BQL query into a dataframe.
+            df = sht.range('E3').expand('right').expand('down').options(pd.DataFrame, index=False, header=True).value
+            labels['rows'] = len(df)
+        self._release(handle)
+        self.session.requests_run += 1
+        return df
+
+    def collect_blocks(self, handle, block_rows):
+        sht = self._sheet(handle)
+        try:
+            # Changing the format of date cells.
+            sht.range('F3').expand('down').number_format = 'yyyy-mm-dd'
+            # Only the size of the result is read here, the values are read block by block.
+            n_rows, n_cols = sht.range('E3').expand('right').expand('down').shape
+            header = sht.range((3, 5), (3, 4 + n_cols)).options(ndim=1).value
+            if n_rows == 1:
+                yield pd.DataFrame(columns=header)
+            for first_row in range(4, 3 + n_rows, block_rows):
+                last_row = min(first_row + block_rows - 1, 2 + n_rows)
+                with run_metrics.stage('sheet_read') as labels:
+                    values = sht.range((first_row, 5), (last_row, 4 + n_cols)).options(ndim=2).value
+                    labels['rows'] = len(values)
+                yield pd.DataFrame(values, columns=header)
+            self.session.requests_run += 1
+        finally:
+            self._release(handle)
+
+    def cancel(self, handle):
+        if handle['generation'] == self.session.generation:
+            self.busy_sheets.discard(handle['sheet'])
+            self.session.clear(handle['sheet'])
+
+    def recover(self):
+        self.busy_sheets = set()
+        self.session.restart()
+
+    def fetch(self, request)->pd.DataFrame:
+        restarts = 0
+        while True:
+            try:
+                handle = self.submit(request)
+                # Checking if the BQL request has finished, waiting a bit longer after each check.
+                # If it takes much longer than the requests usually take the query is pasted again.
+                timeout = self.latency_history.timeout_seconds()
+                time_zero = time.monotonic()
+                time_pasted = time_zero
+                poll_seconds = None
+                while not self.poll(handle):
+                    poll_seconds = self.latency_history.next_poll_seconds(poll_seconds)
+                    time.sleep(poll_seconds)
+                    if time.monotonic() - time_pasted > timeout:
+                        time_pasted = time.monotonic()
+                        poll_seconds = None
+                        sht = self._sheet(handle)
+                        sht.range('E3').clear_contents()
+                        sht.range('E3').formula = handle['query']
+                self.latency_history.record(time.monotonic() - time_zero)
+                return self.collect(handle)
+            except BQLRequestError:
+                # Bloomberg answered with an error, there is nothing to restart.
+                raise
+            except Exception:
+                # Only restarting excel when the add-in (or excel itself) actually failed.
+                traceback.print_exc()
+                if restarts >= self.max_restarts:
+                    raise
+                restarts += 1
+                self.recover()
+
+    def close(self):
+        self.session.close()
+
+
+class FakeBackend(AsyncBQLBackend):
+    """
+    Backend that returns generated responses after a simulated latency. Used to measure the
+    pipeline without excel or a bloomberg terminal.
+
+    Parameters:
+    ----------
+    response_factory : callable
+        Function that receives a BQLRequest and returns the raw response dataframe.
+    latency : float or callable
+        Seconds each request takes, or a function that receives the BQLRequest and returns them.
+    """
+    poll_seconds = 0.01
+
+    def __init__(self, response_factory, latency=0.0):
+        self.response_factory = response_factory
+        self.latency = latency
+        self.requests_run = 0
+        self.seconds_waiting = 0.0
+
+    def submit(self, request):
+        latency = self.latency(request) if callable(self.latency) else self.latency
+        self.seconds_waiting += latency
+        return {'request':request, 'ready_at':time.monotonic() + latency}
+
+    def poll(self, handle)->bool:
+        return time.monotonic() >= handle['ready_at']
+
+    def collect(self, handle)->pd.DataFrame:
+        self.requests_run += 1
+        return self.response_factory(handle['request'])
+
+
+class BQLScheduler:
+    """
+    Keeps several BQL requests in flight at the same time in a backend, polling all of them in a single
+    loop and giving back each response as soon as it is ready.
+
+    Parameters:
+    ----------
+    backend : BQLBackend
+        Backend that runs the requests.
+    max_in_flight : int
+        Maximum number of requests running at the same time.
+    timeout_seconds : float
+        Time after which a request is cancelled and tried again. If None it comes from the latency history.
+    max_retries : int
+        Number of times a request that failed or timed out is tried again.
+    latency_history : RequestLatencyHistory
+        History of the request times, used for the polling backoff and the timeouts.
+    latency_key : callable
+        Function that receives a job_id and returns the key its time is recorded under in the
+        latency history (e.g. the source). If None every request shares the same history.
+    on_failure : callable
+        Function that receives (job_id, request, error) of a request that timed out or failed and may
+        return a list of (job_id, BQLRequest) to run instead of it (e.g. the request split in two).
+        If it returns None the request is retried as usual.
+    block_rows : int
+        If passed, the responses are given back as generators of dataframes of at most block_rows rows
+        (see BQLBackend.collect_blocks) instead of a single dataframe, so a large response is never
+        completely in memory. Each generator has to be consumed before the next result is requested,
+        and an error raised while reading it has to be reported with stream_failed.
+    """
+    def __init__(self, backend, max_in_flight=4, timeout_seconds=None, max_retries=2, latency_history=None, latency_key=None,
+                 on_failure=None, block_rows=None):
+        self.on_failure = on_failure
+        self.block_rows = block_rows
+        self.splits = 0
+        self.job_latencies = {}
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.latency_history = latency_history if latency_history is not None else RequestLatencyHistory()
+        self.latency_key = latency_key
+        self.completed = 0
+        self.cache_hits = 0
+        self.failed = 0
+        self.retries = 0
+        self.elapsed_seconds = 0.0
+        self.latencies = []
+
+    def run(self, jobs):
+        """
+        Runs the jobs and yields their results as they finish.
+
+        Parameters:
+        ----------
+        jobs : iterable
+            Iterable of (job_id, BQLRequest) tuples.
+
+        Returns:
+        -------
+        generator :
+            Yields (job_id, df, error) tuples. df is None and error is the exception if the job
+            failed after all its retries. With block_rows df is a generator of dataframes.
+        """
+        pending = [(job_id, request, 0) for job_id, request in jobs]
+        pending.reverse()
+        in_flight = {}
+        time_zero = time.monotonic()
+        while pending or in_flight:
+            while pending and len(in_flight) < self.max_in_flight:
+                job_id, request, attempts = pending.pop()
+                try:
+                    handle = self.backend.submit(request)
+                except Exception as e:
+                    result = self._failed(pending, job_id, request, attempts, e)
+                    if result is not None:
+                        yield result
+                    continue
+                key = self.latency_key(job_id) if self.latency_key is not None else None
+                timeout = self.timeout_seconds if self.timeout_seconds is not None else self.latency_history.timeout_seconds(key)
+                poll_seconds = self.latency_history.next_poll_seconds()
+                now = time.monotonic()
+                cached = self.backend.is_cached(handle)
+                in_flight[job_id] = {'request':request, 'handle':handle, 'attempts':attempts, 'key':key,
+                                     'started':now, 'timeout':timeout, 'poll_seconds':poll_seconds,
+                                     'next_poll':now if cached else now + poll_seconds, 'cached':cached}
+
+            now = time.monotonic()
+            for job_id in list(in_flight):
+                job = in_flight[job_id]
+                if job['next_poll'] > now:
+                    continue
+                try:
+                    if not self.backend.poll(job['handle']):
+                        if now - job['started'] > job['timeout']:
+                            self.backend.cancel(job['handle'])
+                            raise BQLTimeoutError(f"BQL request {job_id} took more than {job['timeout']:.0f}s.")
+                        # Checking less often the longer the request takes.
+                        job['poll_seconds'] = self.latency_history.next_poll_seconds(job['poll_seconds'])
+                        job['next_poll'] = now + job['poll_seconds']
+                        continue
+                    if self.block_rows is None:
+                        df = self.backend.collect(job['handle'])
+                    else:
+                        # The first block (with the header and the size of the response) is read here, so
+                        # the errors of reading the response are retried like the other ones.
+                        blocks = self.backend.collect_blocks(job['handle'], self.block_rows)
+                        df = itertools.chain([next(blocks)], blocks)
+                except Exception as e:
+                    del in_flight[job_id]
+                    result = self._failed(pending, job_id, job['request'], job['attempts'], e)
+                    if result is not None:
+                        yield result
+                    continue
+                del in_flight[job_id]
+                self.completed += 1
+                if job['cached']:
+                    # Answered without asking bloomberg, its time is left out of the latencies.
+                    self.cache_hits += 1
+                    yield job_id, df, None
+                    continue
+                latency = time.monotonic() - job['started']
+                self.latencies.append(latency)
+                self.job_latencies[job_id] = latency
+                self.latency_history.record(latency, job['key'])
+                run_metrics.record('bloomberg_wait', latency, retries=job['attempts'], tickers=len(job['request'].tickers),
+                                   source=job['key'])
+                yield job_id, df, None
+
+            if in_flight and not (pending and len(in_flight) < self.max_in_flight):
+                # Sleeping until the next request has to be checked.
+                next_poll = min(job['next_poll'] for job in in_flight.values())
+                time.sleep(max(0.0, next_poll - time.monotonic()))
+        self.elapsed_seconds += time.monotonic() - time_zero
+
+    def stream_failed(self, job_id):
+        """
+        Records that the response of a job could not be read to the end (streaming mode). The job was
+        counted as completed when its first block was read.
+        """
+        self.completed -= 1
+        self.failed += 1
+
+    def _failed(self, pending, job_id, request, attempts, error):
+        if isinstance(error, BQLStaleRequestError):
+            # The workbook was restarted because of another request, this one is sent again as it was.
+            pending.append((job_id, request, attempts))
+            return None
+        if isinstance(error, BQLAddinError):
+            self.backend.recover()
+        elif self.on_failure is not None and not isinstance(error, BQLRequestError):
+            new_jobs = self.on_failure(job_id, request, error)
+            if new_jobs:
+                self.splits += 1
+                for new_job_id, new_request in reversed(new_jobs):
+                    pending.append((new_job_id, new_request, 0))
+                return None
+        # Errors answered by bloomberg would happen again, so only the other ones are retried.
+        if attempts < self.max_retries and not isinstance(error, BQLRequestError):
+            self.retries += 1
+            pending.append((job_id, request, attempts + 1))
+            return None
+        self.failed += 1
+        return job_id, None, error
+
+    def report(self)->dict:
+        """
+        Returns the throughput of the requests that were run.
+        """
+        minutes = self.elapsed_seconds / 60
+        return {
+            'completed':self.completed,
+            'cache_hits':self.cache_hits,
+            'failed':self.failed,
+            'retries':self.retries,
+            'splits':self.splits,
+            'elapsed_seconds':round(self.elapsed_seconds, 3),
+            'requests_per_minute':round(self.completed / minutes, 3) if minutes else None,
+            'mean_latency_seconds':round(float(np.mean(self.latencies)), 3) if self.latencies else None,
+            'p95_latency_seconds':round(float(np.percentile(self.latencies, 95)), 3) if self.latencies else None,
+        }
+
+
+class AdaptiveBatchSizer:
+    """
+    Chooses how many tickers go in each BQL request. The size is halved when a request times out or
+    fails, grows after requests that finish fast, and the size with the best throughput (tickers per
+    second) is remembered for each key (functions and source) across runs.
+
+    The sizes learned in a run are only used from the next day on: every run of a day splits the tickers
+    the same way, so a rerun after a failure finds its responses in the BQL cache and a resumed run
+    matches its journal.
+
+    Parameters:
+    ----------
+    path : str
+        JSON file where the sizes are kept between runs.
+    initial_size : int
+        Size used for keys without history.
+    min_size : int
+        Requests with this number of tickers or less are not split.
+    max_size : int
+        Maximum number of tickers in a request.
+    growth : float
+        Factor the size grows after a fast request.
+    fast_seconds : float
+        Requests that finish in less than this grow the size.
+    """
+    def __init__(self, path='bql_batch_sizes.json', initial_size=200, min_size=5, max_size=2000, growth=1.5, fast_seconds=60):
+        self.path = path
+        self.initial_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.growth = growth
+        self.fast_seconds = fast_seconds
+        self.sizes = {}
+        self.day_sizes = {}
+        self.date = datetime.date.today().isoformat()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if 'sizes' in saved:
+                self.sizes = saved['sizes']
+                if saved.get('date') == self.date:
+                    self.day_sizes = saved['day_sizes']
+            else:
+                # Files saved before the sizes of the day were kept.
+                self.sizes = saved
+
+    @staticmethod
+    def key(batch, e_or_a, source)->str:
+        return '|'.join(sorted({func for func, _ in batch})) + f'|{e_or_a}|{source}'
+
+    def _entry(self, key)->dict:
+        return self.sizes.setdefault(key, {'size':self.initial_size, 'best_size':None, 'best_throughput':0.0})
+
+    def size(self, key)->int:
+        """
+        Returns the number of tickers to put in each request of the key, the same for every run of the day.
+        """
+        if key not in self.day_sizes:
+            self.day_sizes[key] = int(max(self.min_size, min(self.max_size, self._entry(key)['size'])))
+        return self.day_sizes[key]
+
+    def record_success(self, key, n_tickers, seconds):
+        entry = self._entry(key)
+        throughput = n_tickers / max(seconds, 1e-6)
+        if throughput > entry['best_throughput']:
+            entry['best_throughput'] = throughput
+            entry['best_size'] = n_tickers
+        if entry['best_size'] is not None and throughput < 0.8 * entry['best_throughput']:
+            # Clearly worse than the best size seen: going back to it.
+            entry['size'] = entry['best_size']
+        elif seconds < self.fast_seconds and n_tickers >= entry['size']:
+            # Fast and full sized: trying bigger requests.
+            entry['size'] = min(self.max_size, int(entry['size'] * self.growth) + 1)
+
+    def record_failure(self, key, n_tickers):
+        entry = self._entry(key)
+        entry['size'] = max(self.min_size, n_tickers // 2)
+        if entry['best_size'] is not None and entry['best_size'] >= n_tickers:
+            # The best size seen is not safe anymore.
+            entry['best_size'] = None
+            entry['best_throughput'] = 0.0
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump({'date':self.date, 'day_sizes':self.day_sizes, 'sizes':self.sizes}, f, indent=2)
+
+
+class ReplayBackend(BQLBackend):
+    """
+    Replays BQL responses previously recorded on disk by RecordingBackend, so the rest of the
+    pipeline can run without a bloomberg terminal or excel.
+
+    Parameters:
+    ----------
+    directory : str
+        Folder where the responses were recorded.
+    ignore_window : bool
+        If True a request without an exact recording is matched on its tickers, measures, source, FPT
+        and AE (BQLRequest.replay_key), ignoring the dates of the window, so recordings can be replayed
+        on a later day.
+    """
+    def __init__(self, directory, ignore_window=True):
+        self.directory = directory
+        self.ignore_window = ignore_window
+        self.replay_index = {}
+        if ignore_window:
+            # Creating the index from the requests saved next to the responses.
+            for file in sorted(os.listdir(directory)):
+                if not file.endswith('.json'):
+                    continue
+                with open(os.path.join(directory, file)) as f:
+                    recorded = json.load(f)
+                request = BQLRequest(recorded['tickers'], recorded['functions'])
+                self.replay_index[request.replay_key()] = file[:-len('.json')]
+
+    def is_cached(self, handle)->bool:
+        # The responses come from disk, their time says nothing about bloomberg.
+        return True
+
+    def fetch(self, request)->pd.DataFrame:
+        key = request.key()
+        if not os.path.exists(os.path.join(self.directory, f'{key}.pkl')) and self.ignore_window:
+            key = self.replay_index.get(request.replay_key(), key)
+        path = os.path.join(self.directory, f'{key}.pkl')
+        if not os.path.exists(path):
+            raise KeyError(f'No recorded response for request {request.key()} in {self.directory}')
+        return pd.read_pickle(path)
+
+
+class RecordingBackend(BQLBackend):
+    """
+    Wraps another backend and saves every response it returns to disk, to be used later with ReplayBackend.
+
+    Parameters:
+    ----------
+    backend : BQLBackend
+        Backend that actually runs the requests.
+    directory : str
+        Folder where the responses will be saved.
+    """
+    def __init__(self, backend, directory):
+        self.backend = backend
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, request, df):
+        key = request.key()
+        df.to_pickle(os.path.join(self.directory, f'{key}.pkl'))
+        # Saving the request next to the response so the recordings are readable.
+        with open(os.path.join(self.directory, f'{key}.json'), 'w') as f:
+            json.dump(request.to_dict(), f, indent=2)
+
+    def fetch(self, request)->pd.DataFrame:
+        df = self.backend.fetch(request)
+        self.save(request, df)
+        return df
+
+    # The requests run in the wrapped backend, so a BQLScheduler keeps several of them in flight,
+    # with its timeouts and recovery, and the responses are saved when they are collected.
+    def submit(self, request):
+        return {'request':request, 'handle':self.backend.submit(request)}
+
+    def poll(self, handle)->bool:
+        return self.backend.poll(handle['handle'])
+
+    def collect(self, handle)->pd.DataFrame:
+        df = self.backend.collect(handle['handle'])
+        self.save(handle['request'], df)
+        return df
+
+    def is_cached(self, handle)->bool:
+        return self.backend.is_cached(handle['handle'])
+
+    def cancel(self, handle):
+        self.backend.cancel(handle['handle'])
+
+    def recover(self):
+        self.backend.recover()
+
+    def close(self):
+        self.backend.close()
+
+
+class BQLResponseCache:
+    """
+    Stores on disk the raw response of every BQL request, so a rerun within the TTL doesn't have to ask
+    bloomberg again. The responses are stored in parquet when pyarrow is available (pickle otherwise),
+    one file per request, named by the request key (functions, with their source, FPT, AE, fields and
+    dates, plus the tickers). When the cache is bigger than max_bytes the least recently used files are removed.
+
+    Parameters:
+    ----------
+    directory : str
+        Folder where the responses are stored.
+    ttl_seconds : float
+        Time a response stays valid.
+    max_bytes : int
+        Maximum size of the cache folder.
+    """
+    def __init__(self, directory='bql_cache', ttl_seconds=12*3600, max_bytes=2*1024**3):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self.directory, f'{key}.parquet'), os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, request):
+        """
+        Returns the stored response of the request, or None if there isn't a valid one.
+        """
+        for path in self._paths(request.key()):
+            if not os.path.exists(path):
+                continue
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                continue
+            try:
+                df = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_pickle(path)
+            except Exception:
+                traceback.print_exc()
+                os.remove(path)
+                continue
+            # Updating the access time, used to find the least recently used files.
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            with self.lock:
+                self.hits += 1
+            return df
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def contains(self, request)->bool:
+        """
+        Returns True if there is a valid stored response for the request, without reading it.
+        """
+        return any(os.path.exists(path) and time.time() - os.path.getmtime(path) <= self.ttl_seconds
+                   for path in self._paths(request.key()))
+
+    def put(self, request, df):
+        """
+        Stores the response of the request and removes old files if the cache is too big.
+        """
+        parquet_path, pickle_path = self._paths(request.key())
+        try:
+            df.to_parquet(parquet_path)
+        except Exception:
+            # No pyarrow, or columns mixing types (e.g. dates and errors) that parquet can't store.
+            if os.path.exists(parquet_path):
+                os.remove(parquet_path)
+            df.to_pickle(pickle_path)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            files.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def report(self)->dict:
+        return {'hits':self.hits, 'misses':self.misses}
+
+
+class CachedBackend(BQLBackend):
+    """
+    Wraps another backend and answers from a BQLResponseCache the requests it already has, only sending
+    the other ones to the wrapped backend.
+
+    Parameters:
+    ----------
+    backend : BQLBackend
+        Backend that actually runs the requests.
+    cache : BQLResponseCache
+        Cache of the responses.
+    """
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def fetch(self, request)->pd.DataFrame:
+        df = self.cache.get(request)
+        if df is None:
+            df = self.backend.fetch(request)
+            self.cache.put(request, df)
+        return df
+
+    def submit(self, request):
+        df = self.cache.get(request)
+        if df is not None:
+            return {'request':request, 'df':df}
+        return {'request':request, 'df':None, 'handle':self.backend.submit(request)}
+
+    def is_cached(self, handle)->bool:
+        return handle['df'] is not None
+
+    def poll(self, handle)->bool:
+        return handle['df'] is not None or self.backend.poll(handle['handle'])
+
+    def collect(self, handle)->pd.DataFrame:
+        if handle['df'] is not None:
+            return handle['df']
+        df = self.backend.collect(handle['handle'])
+        self.cache.put(handle['request'], df)
+        return df
+
+    def cancel(self, handle):
+        if handle['df'] is None:
+            self.backend.cancel(handle['handle'])
+
+    def recover(self):
+        self.backend.recover()
+
+    def close(self):
+        self.backend.close()
+
+
+class LazyBackend(BQLBackend):
+    """
+    Creates the backend that runs the requests the first time a request is sent to it, so a run whose
+    requests are all answered by a CachedBackend never opens excel.
+
+    Parameters:
+    ----------
+    backend_factory : callable
+        Function without arguments that returns the backend.
+    """
+    def __init__(self, backend_factory):
+        self.backend_factory = backend_factory
+        self.backend = None
+
+    def _backend(self):
+        if self.backend is None:
+            self.backend = self.backend_factory()
+        return self.backend
+
+    def fetch(self, request)->pd.DataFrame:
+        return self._backend().fetch(request)
+
+    def submit(self, request):
+        return self._backend().submit(request)
+
+    def poll(self, handle)->bool:
+        return self.backend.poll(handle)
+
+    def collect(self, handle)->pd.DataFrame:
+        return self.backend.collect(handle)
+
+    def collect_blocks(self, handle, block_rows):
+        return self.backend.collect_blocks(handle, block_rows)
+
+    def is_cached(self, handle)->bool:
+        return self.backend.is_cached(handle)
+
+    def cancel(self, handle):
+        self.backend.cancel(handle)
+
+    def recover(self):
+        if self.backend is not None:
+            self.backend.recover()
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+
+def get_df(start,end,bbg_function,tickers,source,type_period,e_or_a,fields,backend=None):
+    """
+    This function creates a dataframe with a friendly format based on the response of the BQL query.
+
+    Parameters:
+    ----------
+    start : str
+        The start date in string format (yyyy-mm-dd).
+    end : str
+        The end date in string format (yyyy-mm-dd).
+    bbg_function : str
+        Bloomberg function used in the bloomberg terminal or BQL queries to get companies financials.
+    tickers : list
+        List of tickers used to get financials of.
+    source : str
+        Source parameters that is passed to the bloomberg function. It defines from what vendors the data will come from. 
+    type_period : str
+        Type of financial period you have interest in getting. 'Q' for quarter, 'A' for annual.
+    e_or_a : str
+        Defines if the value will is an estimate ('E') or the actual realized value ('A').
+    fields : list
+        List of fields that will be retrived from each fuction passed to the BQL query.
+    backend : BQLBackend
+        Backend that runs the BQL request. Defaults to a XlwingsBackend.
+    
+    Returns:
+    -------
+    df : pandas.DataFrame
+        Returns a pandas dataframe with a friendly format.
+    """
+    dict_dfs = get_batch_dfs(start,end,[(bbg_function,type_period)],tickers,source,e_or_a,fields,backend=backend)
+    return dict_dfs[(bbg_function,type_period)]
+
+def plan_bql_batches(bql_functions, periods, n_fields, max_fields_per_request=60, pack_periods=True)->list[list]:
+    """
+    This function groups the measures (BQL function and periodicity) so that several of them are sent in
+    a single BQL request, instead of one request per measure.
+
+    Parameters:
+    ----------
+    bql_functions : list
+        List of BQL functions (measures).
+    periods : list
+        List of periodicities ('A', 'Q').
+    n_fields : int
+        Number of fields requested for each measure.
+    max_fields_per_request : int
+        Maximum number of BQL fields (measures x fields) in a single request.
+    pack_periods : bool
+        If True the 'A' and 'Q' variants of a measure can go in the same request.
+
+    Returns:
+    -------
+    list(list):
+        Returns a list of batches, each batch being a list of (bql_function, period) tuples.
+    """
+    measures_per_request = max(1, max_fields_per_request // max(1, n_fields))
+    if pack_periods:
+        items = [(func, type_period) for func in bql_functions for type_period in periods]
+        return separa_lista(items, measures_per_request)
+    batches = []
+    for type_period in periods:
+        items = [(func, type_period) for func in bql_functions]
+        batches.extend(separa_lista(items, measures_per_request))
+    return batches
+
+def split_batched_response(df, batch, n_fields)->dict:
+    """
+    This function splits the raw response of a batched BQL request back into one raw dataframe per measure.
+    The response has an 'ID' column followed by one column per BQL function, in the same order they were
+    pasted in excel.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        Raw response of the batched BQL request.
+    batch : list
+        List of (bql_function, period) tuples that were sent in the request.
+    n_fields : int
+        Number of fields requested for each measure.
+
+    Returns:
+    -------
+    dict :
+        Returns a dictionary {(bql_function, period): raw dataframe}.
+    """
+    if len(df.columns) - 1 != len(batch) * n_fields:
+        raise ValueError(f'Expected {len(batch) * n_fields} columns in the BQL response, got {len(df.columns) - 1}.')
+    dict_dfs = {}
+    id_col = df.columns[0]
+    for i, measure in enumerate(batch):
+        cols = list(df.columns[1 + i*n_fields : 1 + (i+1)*n_fields])
+        df_measure = df[[id_col] + cols]
+        # Rows that belong to other measures of the batch are empty for this one.
+        df_measure = df_measure.dropna(subset = cols, how = 'all')
+        dict_dfs[measure] = df_measure
+    return dict_dfs
+
+def get_batch_dfs(start,end,batch,tickers,source,e_or_a,fields,backend=None)->dict:
+    """
+    This function gets several measures in a single BQL request and returns one dataframe with
+    a friendly format for each of them.
+
+    Parameters:
+    ----------
+    start : str
+        The start date in string format (yyyy-mm-dd).
+    end : str
+        The end date in string format (yyyy-mm-dd).
+    batch : list
+        List of (bql_function, period) tuples, see plan_bql_batches.
+    tickers : list
+        List of tickers used to get financials of.
+    source : str
+        Source parameters that is passed to the bloomberg functions.
+    e_or_a : str
+        Defines if the value will is an estimate ('E') or the actual realized value ('A').
+    fields : list
+        List of fields that will be retrived from each fuction passed to the BQL query.
+    backend : BQLBackend
+        Backend that runs the BQL request. Defaults to a XlwingsBackend.
+
+    Returns:
+    -------
+    dict :
+        Returns a dictionary {(bql_function, period): pandas.DataFrame}.
+    """
+    request = create_batch_request(start,end,batch,tickers,source,e_or_a,fields)
+    if backend is None:
+        # The workbook opened for this request is closed once it is answered.
+        backend = XlwingsBackend()
+        try:
+            df = backend.fetch(request)
+        finally:
+            backend.close()
+    else:
+        df = backend.fetch(request)
+    return process_batch_response(df,batch,source,e_or_a,len(fields))
+
+def create_batch_request(start,end,batch,tickers,source,e_or_a,fields)->BQLRequest:
+    """
+    This function creates the BQL request for a batch of measures.
+
+    Parameters:
+    ----------
+    start : str
+        The start date in string format (yyyy-mm-dd).
+    end : str
+        The end date in string format (yyyy-mm-dd).
+    batch : list
+        List of (bql_function, period) tuples, see plan_bql_batches.
+    tickers : list
+        List of tickers used to get financials of.
+    source : str
+        Source parameters that is passed to the bloomberg functions.
+    e_or_a : str
+        Defines if the value will is an estimate ('E') or the actual realized value ('A').
+    fields : list
+        List of fields that will be retrived from each fuction passed to the BQL query.
+
+    Returns:
+    -------
+    BQLRequest :
+        Returns the request to be run by a BQLBackend.
+    """
+    # If "A" (representing actual values) is passed then there is no need to look for the future.
+    if e_or_a == 'A':
+        end = datetime.datetime.today().strftime('%Y-%m-%d')
+    list_bql_func = []
+    for bbg_function, type_period in batch:
+        list_bql_func.extend(create_bql_functions_list(bbg_function,source,start,end,type_period,e_or_a,fields))
+    return BQLRequest(tickers,list_bql_func)
+
+def process_batch_response(df,batch,source,e_or_a,n_fields)->dict:
+    """
+    This function splits the raw response of a batch request by measure and gives each of them a friendly format.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        Raw response of the BQL request.
+    batch : list
+        List of (bql_function, period) tuples that were sent in the request.
+    source : str
+        Source parameters that was passed to the bloomberg functions.
+    e_or_a : str
+        Defines if the value is an estimate ('E') or the actual realized value ('A').
+    n_fields : int
+        Number of fields requested for each measure.
+
+    Returns:
+    -------
+    dict :
+        Returns a dictionary {(bql_function, period): pandas.DataFrame}.
+    """
+    dict_raw_dfs = split_batched_response(df, batch, n_fields)
+    dict_dfs = {}
+    for (bbg_function, type_period), df_raw in dict_raw_dfs.items():
+        dict_dfs[(bbg_function, type_period)] = process_bql_response(df_raw,bbg_function,source,type_period,e_or_a)
+    return dict_dfs
+
+@timed_stage('get_df_postprocessing')
+def process_bql_response(df,bbg_function,source,type_period,e_or_a)->pd.DataFrame:
+    """
+    This function turns the raw response of a BQL request into a dataframe with a friendly format.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        Raw response of the BQL request, as returned by a BQLBackend.
+    bbg_function : str
+        Bloomberg function used in the BQL query.
+    source : str
+        Source parameters that was passed to the bloomberg function.
+    type_period : str
+        Type of financial period. 'Q' for quarter, 'A' for annual.
+    e_or_a : str
+        Defines if the value is an estimate ('E') or the actual realized value ('A').
+
+    Returns:
+    -------
+    df : pandas.DataFrame
+        Returns a pandas dataframe with a friendly format.
+    """
+    df = df.drop_duplicates()
+    for i in range(len(df.columns)-1):
+        df = df.rename(columns = {df.columns[i+1]:df.columns[i+1].split('.')[-1].lower()})
+        #df = df.rename(columns = {df.columns[i+1]:fields[i].lower()})
+    
+    
+    df = df.dropna(subset = 'value')
+    df = df.dropna(subset = 'period')
+
+    # Revisions without a date get 1900-01-01.
+    df['revision_date'] = pd.to_datetime(df['revision_date']).fillna(pd.Timestamp('1900-01-01'))
+    df['measure'] = bbg_function
+    df['actual_or_estimate'] = e_or_a
+    df['date'] = periods_to_dates(df['period'])
+    df['period'] = type_period
+    df = df.rename(columns = {'firm_name':'source'})
+    if source == "BST":
+        df['source'] = 'bst_estimate'
+    # Otherwise the source is kept: fill_source_if_actual only changes it when row[['source']] is empty,
+    # which never happens once the row has the column.
+    
+    if not 'currency' in df.columns:
+        df['currency'] = 'N/A'
+
+    return apply_financials_schema(df)
+
+# Dtypes of the dataframes of financials. The text columns repeat a few values on every row, so they are
+# categoricals; the dates and the value have fixed dtypes instead of python objects.
+FINANCIALS_SCHEMA = {'ID':'category','measure':'category','source':'category','period':'category',
+                     'actual_or_estimate':'category','currency':'category','date':'datetime64[ns]',
+                     'revision_date':'datetime64[ns]','value':'float64'}
+
+def apply_financials_schema(df)->pd.DataFrame:
+    """
+    This function gives the columns of a dataframe of financials the dtypes of FINANCIALS_SCHEMA.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        Dataframe with a friendly format, see process_bql_response.
+
+    Returns:
+    -------
+    df : pandas.DataFrame
+        Returns the dataframe with the dtypes of the schema (columns not in the dataframe are ignored).
+    """
+    return df.astype({col:dtype for col, dtype in FINANCIALS_SCHEMA.items() if col in df.columns})
+
+def has_financials_schema(df)->bool:
+    """
+    Returns True if the columns of the dataframe already have the dtypes of FINANCIALS_SCHEMA.
+    """
+    return all(str(df[col].dtype) == dtype for col, dtype in FINANCIALS_SCHEMA.items() if col in df.columns)
+
+def concat_financials(list_dfs)->pd.DataFrame:
+    """
+    This function concatenates dataframes of financials keeping the categorical columns. pd.concat turns
+    categoricals into objects when the categories of the dataframes are different, so each categorical
+    column is joined with union_categoricals instead.
+
+    Parameters:
+    ----------
+    list_dfs : list
+        List of dataframes of financials, see process_bql_response.
+
+    Returns:
+    -------
+    pandas.DataFrame :
+        Returns the concatenated dataframe, with the dtypes of FINANCIALS_SCHEMA.
+    """
+    list_dfs = [df if has_financials_schema(df) else apply_financials_schema(df) for df in list_dfs]
+    if len(list_dfs) <= 1 or any(not df.columns.equals(list_dfs[0].columns) for df in list_dfs):
+        return apply_financials_schema(pd.concat(list_dfs))
+    dict_cols = {}
+    for col in list_dfs[0].columns:
+        if isinstance(list_dfs[0][col].dtype, pd.CategoricalDtype):
+            dict_cols[col] = union_categoricals([df[col] for df in list_dfs])
+        else:
+            dict_cols[col] = np.concatenate([df[col].to_numpy() for df in list_dfs])
+    index = list_dfs[0].index.append([df.index for df in list_dfs[1:]])
+    return pd.DataFrame(dict_cols, index=index)
+
+# Columns of the dataframe that make the '_id' of the documents, and the key they get in it.
+ID_COLUMNS = {'date':'date','ID':'bbg_ticker','measure':'measure','source':'source','period':'period',
+              'actual_or_estimate':'actual_or_estimate','revision_date':'revision_date','currency':'currency'}
+
+def iter_dict_upload(df):
+    """
+    This function creates the dictionaries in a BSON format to upload to MongoDB one at a time,
+    reading the columns of the dataframe as arrays instead of building a row for each document.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame()
+        A panda dataframe with columns : date , ID , measure , source , period , 
+        actual_or_estimate , revision_date , currency , value.
+    
+    Returns:
+    -------
+    generator :
+        Yields the dictionaries in BSON format.
+    """
+    # Converting to object arrays gives the same python objects (Timestamps, floats, str) iterrows gave,
+    # also for the categorical columns.
+    keys = list(ID_COLUMNS.values())
+    id_arrays = [df[col].to_numpy(dtype=object) for col in ID_COLUMNS]
+    values = df['value'].round(6).to_numpy(dtype=object)
+    for id_values, value in zip(zip(*id_arrays), values):
+        yield {'_id':dict(zip(keys, id_values)), 'value':value}
+
+@timed_stage('document_building')
+def create_list_dict_upload(df):
+    """
+    This function creates a list of dictionaries in a BSON format to later upload to MongoDB
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame()
+        A panda dataframe with columns : date , ID , measure , source , period , 
+        actual_or_estimate , revision_date , currency , value.
+    
+    Returns:
+    -------
+    list_dict_upload : list[dict]
+        Returns a list of dictionaries in BSON format for later upload to MongoDB.
+    """
+    # Making sure values don't take too much memory needlessly
+    df['value'] = df['value'].round(6)
+    return list(iter_dict_upload(df))
+
+class FingerprintStore:
+    """
+    Keeps on disk a hash of the '_id' and of the value of every document that was uploaded to MongoDB,
+    so the next runs only upload the documents that are new or whose value changed.
+
+    The '_id' includes the revision date, so every revision adds a new key. The store keeps the last run
+    each key was seen in and drops on save the ones not seen for max_idle_runs runs; a document dropped by
+    mistake is just uploaded again.
+
+    Parameters:
+    ----------
+    path : str
+        File (.npz) where the fingerprints are stored.
+    max_idle_runs : int
+        Number of runs a key is kept without being seen. If None the keys are never dropped.
+    """
+    def __init__(self, path='company_financials_fingerprints.npz', max_idle_runs=30):
+        self.path = path
+        self.max_idle_runs = max_idle_runs
+        self.fingerprints = {}
+        self.last_seen = {}
+        self.run = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def _hash(text)->int:
+        return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def _key_value(self, doc):
+        key = '|'.join(str(doc['_id'][k]) for k in ID_COLUMNS.values())
+        return self._hash(key), self._hash(repr(doc['value']))
+
+    def changed(self, list_dict_upload)->list:
+        """
+        Returns the documents that are not in the store or whose value is different from the stored one.
+        """
+        list_changed = []
+        with self.lock:
+            for doc in list_dict_upload:
+                key, value = self._key_value(doc)
+                self.last_seen[key] = self.run
+                if self.fingerprints.get(key) != value:
+                    list_changed.append(doc)
+        return list_changed
+
+    def record(self, list_dict_upload):
+        """
+        Stores the fingerprints of documents that were uploaded.
+        """
+        with self.lock:
+            for doc in list_dict_upload:
+                key, value = self._key_value(doc)
+                self.fingerprints[key] = value
+                self.last_seen[key] = self.run
+
+    def rebuild_from_collection(self, collection, query=None):
+        """
+        Replaces the fingerprints with the ones of the documents already in a MongoDB collection.
+        """
+        with self.lock:
+            self.fingerprints = {}
+            self.last_seen = {}
+        documents = collection.find(query or {}, {'_id':1, 'value':1})
+        for list_docs in iter_chunks(documents, 10000):
+            self.record(list_docs)
+
+    def load(self):
+        arrays = np.load(self.path)
+        with self.lock:
+            keys = arrays['keys'].tolist()
+            self.fingerprints = dict(zip(keys, arrays['values'].tolist()))
+            # Stores saved before the runs were kept count as seen in the previous run.
+            self.run = int(arrays['run']) + 1 if 'run' in arrays.files else 1
+            if 'last_seen' in arrays.files:
+                self.last_seen = dict(zip(keys, arrays['last_seen'].tolist()))
+            else:
+                self.last_seen = dict.fromkeys(keys, self.run - 1)
+
+    def prune(self)->int:
+        """
+        Drops the keys not seen for more than max_idle_runs runs and returns how many were dropped.
+        """
+        if self.max_idle_runs is None:
+            return 0
+        with self.lock:
+            stale = [key for key, run in self.last_seen.items() if self.run - run > self.max_idle_runs]
+            for key in stale:
+                self.fingerprints.pop(key, None)
+                del self.last_seen[key]
+        return len(stale)
+
+    def save(self):
+        n_pruned = self.prune()
+        if n_pruned:
+            print(f'{n_pruned} fingerprints not seen for {self.max_idle_runs} runs were dropped.')
+        with self.lock:
+            keys = np.fromiter(self.fingerprints.keys(), dtype=np.uint64, count=len(self.fingerprints))
+            values = np.fromiter(self.fingerprints.values(), dtype=np.uint64, count=len(self.fingerprints))
+            last_seen = np.fromiter((self.last_seen.get(key, self.run) for key in self.fingerprints),
+                                    dtype=np.int64, count=len(self.fingerprints))
+        # Writing to a temporary file first so an interrupted save doesn't lose the store.
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, keys=keys, values=values, last_seen=last_seen, run=np.int64(self.run))
+        os.replace(tmp_path, self.path)
+
+
+def iter_chunks(iterable, n):
+    """
+    This fuction divides any iterable into lists of at most n itens, without loading it all in memory.
+
+    Parameters:
+    ----------
+    iterable : iterable
+        Iterable to be separated.
+    n : int
+        Maximum number of itens in each list.
+
+    Returns:
+    --------
+    generator :
+        Yields lists.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_last(iterable):
+    """
+    This function yields the itens of an iterable together with a flag that is True for the last one.
+
+    Parameters:
+    ----------
+    iterable : iterable
+        Iterable to be read.
+
+    Returns:
+    --------
+    generator :
+        Yields (item, is_last) tuples.
+    """
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+class RunJournal:
+    """
+    Append-only journal (one JSON per line) of the work done in a run: every BQL unit fetched, every
+    chunk uploaded and every unit completely uploaded. A unit is a (ticker batch, function, actual or
+    estimate, source, period). It lets a run that stopped in the middle be resumed from where it was.
+    The journal starts with the date of the run and ends with a 'finished' record when the run finishes.
+
+    The requests planned at the start of the run (and the halves of the ones that were split) are also
+    recorded, since the ticker batches of a new plan may be different (batch sizes and stale tickers change
+    between runs). A resumed run replays that plan, so its units match the ones already uploaded.
+
+    Parameters:
+    ----------
+    path : str
+        File of the journal.
+    resume : bool
+        If True the records of the previous run are kept and loaded, otherwise the journal starts empty.
+        A previous run that finished or that started on another day isn't resumed (see resumed).
+    read_only : bool
+        If True the journal file isn't opened to be written (used by the dry run).
+    """
+    def __init__(self, path='run_journal.jsonl', resume=False, read_only=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fetched = set()
+        self.uploaded = set()
+        self.batches = None
+        self.jobs = {}
+        self.splits = {}
+        self.tickers_groups = {}
+        today = datetime.date.today().isoformat()
+        run_date = None
+        finished = False
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be incomplete if the run stopped while writing it.
+                        continue
+                    if record['kind'] == 'started':
+                        run_date = record['date']
+                    elif record['kind'] == 'finished':
+                        finished = True
+                    elif record['kind'] == 'fetch':
+                        self.fetched.add(record['unit'])
+                    elif record['kind'] == 'uploaded':
+                        self.uploaded.add(record['unit'])
+                    elif record['kind'] == 'plan':
+                        self.batches = [[tuple(item) for item in batch] for batch in record['batches']]
+                    elif record['kind'] == 'tickers':
+                        self.tickers_groups[record['unit']] = record['tickers']
+                    elif record['kind'] == 'job':
+                        job_id = self._job_id(record['job'])
+                        self.jobs[job_id] = self.tickers_groups[record['unit']]
+                        if record.get('parent') is not None:
+                            self.splits.setdefault(self._job_id(record['parent']), []).append(job_id)
+        # Only a run of today that stopped in the middle is resumed, the data of older runs may have changed.
+        self.resumed = resume and run_date == today and not finished
+        if not self.resumed:
+            self.fetched = set()
+            self.uploaded = set()
+            self.batches = None
+            self.jobs = {}
+            self.splits = {}
+            self.tickers_groups = {}
+        self.file = None
+        if not read_only:
+            self.file = open(path, 'a' if self.resumed else 'w')
+            if not self.resumed:
+                self.record('started', None, date=today)
+
+    @staticmethod
+    def unit(tickers, measure, e_or_a, source, type_period)->str:
+        tickers_hash = hashlib.sha1('\n'.join(tickers).encode('utf-8')).hexdigest()[:12]
+        return f'{tickers_hash}|{measure}|{e_or_a}|{source}|{type_period}'
+
+    def record(self, kind, unit, **kwargs):
+        """
+        Appends a record to the journal. kind is 'started', 'fetch', 'chunk', 'uploaded' or 'finished'.
+        """
+        line = json.dumps({'kind':kind, 'unit':unit, 'time':datetime.datetime.now().isoformat(), **kwargs})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            if kind == 'fetch':
+                self.fetched.add(unit)
+            elif kind == 'uploaded':
+                self.uploaded.add(unit)
+
+    @staticmethod
+    def _job_id(job)->tuple:
+        # JSON turns the tuples of the job ids into lists.
+        tickers_id, batch_index, e_or_a, source = job
+        return (tuple(tickers_id), batch_index, e_or_a, source)
+
+    def _record_job(self, job_id, tickers, parent=None):
+        tickers_key = hashlib.sha1('\n'.join(tickers).encode('utf-8')).hexdigest()[:12]
+        if tickers_key not in self.tickers_groups:
+            # Each list of tickers is written once, most of the requests share them.
+            self.tickers_groups[tickers_key] = list(tickers)
+            self.record('tickers', tickers_key, tickers=list(tickers))
+        self.jobs[job_id] = list(tickers)
+        self.record('job', tickers_key, job=job_id, parent=parent)
+
+    def record_plan(self, batches, planned_jobs):
+        """
+        Records the batches of functions and the (job_id, tickers) of the requests planned for the run.
+        """
+        self.batches = [list(batch) for batch in batches]
+        self.record('plan', None, batches=self.batches)
+        for job_id, tickers in planned_jobs:
+            self._record_job(job_id, tickers)
+
+    def record_split(self, job_id, new_jobs):
+        """
+        Records the (job_id, tickers) of the requests a failed request was split into.
+        """
+        for new_job_id, tickers in new_jobs:
+            self._record_job(new_job_id, tickers, parent=job_id)
+        self.splits[job_id] = [new_job_id for new_job_id, _ in new_jobs]
+
+    def planned_jobs(self)->list:
+        """
+        Returns the (job_id, tickers) of the recorded plan, with the requests that were split replaced by
+        their halves. Returns None if there is no plan (a new run, or a journal written before the plans
+        were recorded).
+        """
+        if self.batches is None:
+            return None
+        planned = []
+        def expand(job_id):
+            if job_id in self.splits:
+                for new_job_id in self.splits[job_id]:
+                    expand(new_job_id)
+            else:
+                planned.append((job_id, self.jobs[job_id]))
+        halves = {new_job_id for new_job_ids in self.splits.values() for new_job_id in new_job_ids}
+        for job_id in [job_id for job_id in self.jobs if job_id not in halves]:
+            expand(job_id)
+        return planned
+
+    def finish(self):
+        """
+        Records that the run finished, so it isn't resumed.
+        """
+        self.record('finished', None, date=datetime.date.today().isoformat())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class MongoConnection:
+    """
+    Keeps a single MongoDB client open for the whole run, instead of one client for each chunk of documents.
+    The client is opened the first time it is needed and opened again if the connection is lost.
+
+    Parameters:
+    ----------
+    environment : str
+        Environment of the database ('PROD', ...), passed to MongoDB.get_mongo_conn.
+    client_factory : callable
+        Function that receives the environment and returns an OurMongoClient (or any object with a
+        pymongo client in its 'client' attribute). Defaults to MongoDB.OurMongoClient.
+    """
+    def __init__(self, environment='PROD', client_factory=None):
+        self.environment = environment
+        self.client_factory = client_factory
+        self.mdb = None
+        self.connections_opened = 0
+
+    def open(self):
+        if self.mdb is None:
+            if self.client_factory is None:
+                load_internal_libs()
+                self.mdb = MongoDB.OurMongoClient(MongoDB.get_mongo_conn(environment=self.environment))
+            else:
+                self.mdb = self.client_factory(self.environment)
+            self.connections_opened += 1
+        return self.mdb
+
+    def collection(self, database, collection):
+        """
+        Returns a collection of the database, opening the client if needed.
+        """
+        return self.open().client[database][collection]
+
+    def reset(self):
+        """
+        Closes the client so the next operation opens a new one. Used after losing the connection.
+        """
+        self.close()
+
+    def close(self):
+        if self.mdb is not None:
+            try:
+                self.mdb.client.close()
+            finally:
+                self.mdb = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class MongoBulkWriter:
+    """
+    Uploads documents to a MongoDB collection with several writer threads. The documents are split in
+    batches that are written as unordered bulk operations (a ReplaceOne upsert by '_id' for each document),
+    so a document that fails doesn't stop the others. Only the documents that failed are tried again.
+
+    Parameters:
+    ----------
+    connection : MongoConnection
+        Connection shared by the writers (the pymongo client is thread-safe).
+    database : str
+        Database of the collection.
+    collection : str
+        Collection where the documents are written.
+    n_writers : int
+        Number of batches written at the same time.
+    batch_size : int
+        Maximum number of documents in each bulk operation.
+    write_concern : dict
+        Arguments of the pymongo WriteConcern of the writes (e.g. {'w':1}). If None the one of the
+        collection is used.
+    max_retries : int
+        Number of times the documents that failed in a batch are tried again.
+    fingerprints : FingerprintStore
+        If passed, the fingerprints of the documents are recorded once they are written.
+    """
+    def __init__(self, connection, database='gestao', collection='bbg.company_financials', n_writers=4,
+                 batch_size=1000, write_concern=None, max_retries=2, fingerprints=None):
+        self.connection = connection
+        self.database = database
+        self.collection_name = collection
+        self.n_writers = n_writers
+        self.batch_size = batch_size
+        self.write_concern = write_concern
+        self.max_retries = max_retries
+        self.fingerprints = fingerprints
+        self.executor = None
+
+    def _collection(self):
+        collection = self.connection.collection(self.database, self.collection_name)
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=WriteConcern(**self.write_concern))
+        return collection
+
+    def _write_batch(self, collection, documents)->dict:
+        counts = {'upserted':0, 'modified':0, 'matched':0, 'failed':0, 'retries':0}
+        written = []
+        attempt = 0
+        while documents:
+            operations = [ReplaceOne({'_id':doc['_id']}, doc, upsert=True) for doc in documents]
+            try:
+                with run_metrics.stage('upload_chunk', rows=len(documents)):
+                    result = collection.bulk_write(operations, ordered=False)
+                counts['upserted'] += result.upserted_count
+                counts['modified'] += result.modified_count
+                counts['matched'] += result.matched_count
+                written.extend(documents)
+                documents = []
+            except BulkWriteError as e:
+                details = e.details
+                counts['upserted'] += details.get('nUpserted', 0)
+                counts['modified'] += details.get('nModified', 0)
+                counts['matched'] += details.get('nMatched', 0)
+                # With unordered writes every document not in writeErrors was written.
+                failed_indexes = {error['index'] for error in details.get('writeErrors', [])}
+                written.extend(doc for i, doc in enumerate(documents) if i not in failed_indexes)
+                documents = [documents[i] for i in sorted(failed_indexes)]
+                if documents:
+                    last_error = details['writeErrors'][0].get('errmsg')
+            except Exception as e:
+                # The whole batch failed (e.g. the connection was lost), pymongo reconnects in the next try.
+                last_error = repr(e)
+            if documents:
+                if attempt >= self.max_retries:
+                    print(f"Error: {len(documents)} documents couldn't be uploaded to DataBase: {last_error}")
+                    counts['failed'] += len(documents)
+                    break
+                attempt += 1
+                counts['retries'] += 1
+        if self.fingerprints is not None and written:
+            self.fingerprints.record(written)
+        return counts
+
+    def write(self, documents)->dict:
+        """
+        Writes the documents and waits for them to be written.
+
+        Parameters:
+        ----------
+        documents : iterable
+            Documents in BSON format, see create_list_dict_upload. Read batch by batch, so it can be a generator.
+
+        Returns:
+        -------
+        dict :
+            Returns the number of documents 'upserted', 'modified', 'matched' and 'failed', and the number
+            of 'retries' of batches.
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_writers, thread_name_prefix='mongo-bulk')
+        collection = self._collection()
+        counts = {'upserted':0, 'modified':0, 'matched':0, 'failed':0, 'retries':0}
+        futures = set()
+        for batch in iter_chunks(documents, self.batch_size):
+            # Keeping at most two batches per writer waiting, so a generator isn't read all at once.
+            if len(futures) >= 2 * self.n_writers:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for key, n in future.result().items():
+                        counts[key] += n
+            futures.add(self.executor.submit(self._write_batch, collection, batch))
+        for future in concurrent.futures.as_completed(futures):
+            for key, n in future.result().items():
+                counts[key] += n
+        return counts
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def upload_dfs(list_dfs, connection=None, fingerprints=None, journal=None, unit=None, complete=True, writer=None)->bool:
+    """
+    This function creates the documents of a list of dataframes and uploads them to mongoDB in chunks.
+
+    Parameters:
+    ----------
+    list_dfs : list
+        List of dataframes returned by get_df.
+    connection : MongoConnection
+        Connection used by every chunk. See upload_to_mongo.
+    fingerprints : FingerprintStore
+        If passed, only the documents that are new or changed since the last upload are sent.
+    journal : RunJournal
+        If passed, every chunk uploaded and the unit, once completely uploaded, are recorded in it.
+    unit : str
+        Unit of the dataframes in the journal, see RunJournal.unit.
+    complete : bool
+        If False more dataframes of the unit will still be uploaded, so it isn't recorded as uploaded.
+    writer : MongoBulkWriter
+        If passed, the documents are written by it instead of chunk by chunk with upload_to_mongo.
+
+    Returns:
+    --------
+    True or False : Boolean
+        Returns True if every chunk was uploaded and False if any wasn't.
+    """
+    df_concat = concat_financials(list_dfs)
+    list_dict_upload = create_list_dict_upload(df_concat)
+    if fingerprints is not None:
+        list_dict_upload = fingerprints.changed(list_dict_upload)
+    if writer is not None:
+        counts = writer.write(list_dict_upload)
+        if journal is not None:
+            journal.record('chunk', unit, chunk=0, documents=len(list_dict_upload), **counts)
+            if counts['failed'] == 0 and complete:
+                journal.record('uploaded', unit)
+        return counts['failed'] == 0
+    # Separating the list to upload to lists with a maximum of 1000 documents.
+    list_of_list_dict_upload = separa_lista(list_dict_upload,1000)
+    list_was_uploaded = []
+    for i, list_upload in enumerate(list_of_list_dict_upload):
+        was_uploaded = upload_to_mongo(list_upload, connection=connection, fingerprints=fingerprints)
+        list_was_uploaded.append(was_uploaded)
+        if was_uploaded and journal is not None:
+            journal.record('chunk', unit, chunk=i, documents=len(list_upload))
+    if all(list_was_uploaded) and complete and journal is not None:
+        journal.record('uploaded', unit)
+    return all(list_was_uploaded)
+
+class UploadPipeline:
+    """
+    Builds the documents of the fetched dataframes and uploads them to MongoDB in a background thread,
+    while the next BQL requests are already running. The queue between the two is bounded, so fetching
+    waits when the uploads fall behind.
+
+    Parameters:
+    ----------
+    connection : MongoConnection
+        Connection used by the uploads.
+    max_queue : int
+        Maximum number of dataframes waiting to be uploaded.
+    upload_func : callable
+        Function that receives a list of dataframes, uploads them and returns True or False.
+        Defaults to upload_dfs with the connection.
+    fingerprints : FingerprintStore
+        Passed to upload_dfs to only upload new or changed documents.
+    journal : RunJournal
+        Passed to upload_dfs to record the uploaded chunks and units.
+    writer : MongoBulkWriter
+        Passed to upload_dfs to write the documents with several threads.
+    """
+    _stop = object()
+
+    def __init__(self, connection=None, max_queue=8, upload_func=None, fingerprints=None, journal=None, writer=None):
+        self.connection = connection
+        self.writer = writer
+        self.fingerprints = fingerprints
+        self.journal = journal
+        self.upload_func = upload_func
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        # Dictionary that stores if every function was successfully uploaded to MongoDB.
+        self.already_uploaded = {}
+        # Units with a part that failed to upload, they can't be recorded as uploaded.
+        self.failed_units = set()
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._writer, name='mongo-writer', daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        try:
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is self._stop:
+                        return
+                    func, df, unit, complete = item
+                    try:
+                        if self.upload_func is None:
+                            was_uploaded = upload_dfs([df], connection=self.connection, fingerprints=self.fingerprints,
+                                                      journal=self.journal, unit=unit,
+                                                      complete=complete and unit not in self.failed_units,
+                                                      writer=self.writer)
+                        else:
+                            was_uploaded = self.upload_func([df])
+                    except Exception:
+                        traceback.print_exc()
+                        was_uploaded = False
+                    if not was_uploaded:
+                        self.failed_units.add(unit)
+                    self._record(func, was_uploaded)
+                finally:
+                    self.queue.task_done()
+        except BaseException as e:
+            self.error = e
+
+    def _record(self, func, was_uploaded):
+        with self.lock:
+            # A function is only uploaded if all of its dataframes were.
+            self.already_uploaded[func] = [was_uploaded and self.already_uploaded.get(func, [True])[0]]
+
+    def put(self, func, df, unit=None, complete=True):
+        """
+        Adds a dataframe of a function to be uploaded. Blocks while the queue is full.
+        unit is the unit of the dataframe in the journal. When a unit is uploaded in several parts
+        (streaming mode) complete is only True for the last one.
+        """
+        if self.error is not None or self.thread is None or not self.thread.is_alive():
+            raise RuntimeError('The upload thread is not running.') from self.error
+        self.queue.put((func, df, unit, complete))
+
+    def mark_failed(self, func):
+        """
+        Records that a function could not be uploaded (e.g. its BQL request failed).
+        """
+        self._record(func, False)
+
+    def close(self)->dict:
+        """
+        Waits for the queued dataframes to be uploaded, stops the thread and returns already_uploaded.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('The upload thread failed.') from self.error
+        return self.already_uploaded
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def upload_to_mongo(list_dict_upload, connection=None, fingerprints=None):
+    """
+    This function uploads a list of documents to mongoDB.
+
+    Parameters:
+    -----------
+    list_dict_upload : list
+        List of dictionaries in a format to facilitate upload to mongoDB.
+    connection : MongoConnection
+        Connection shared by the uploads. If None a connection to 'PROD' is opened and closed only for this upload.
+    fingerprints : FingerprintStore
+        If passed, the fingerprints of the documents are recorded once they are uploaded.
+
+    Returns:
+    --------
+    True or False : Boolean
+        Returns True if the upload was successful and False if it wasn't.
+    """
+    own_connection = connection is None
+    if own_connection:
+        # Creating a mongoDB connection
+        connection = MongoConnection('PROD')
+    # Uploading the list of dictionaries we created.
+    try:
+        # Storing the collection where the data will be stored
+        financials_collection = connection.collection('gestao','bbg.company_financials')
+        load_internal_libs()
+        with run_metrics.stage('upload_chunk', rows=len(list_dict_upload)):
+            mongo.bulk_update(financials_collection,list_dict_upload)
+        if fingerprints is not None:
+            fingerprints.record(list_dict_upload)
+        #print('Script was successful!')
+        return True
+    except Exception as e:
+        traceback.print_exc()
+        print(e)
+        if isinstance(e, MongoConnectionFailure):
+            # The next upload will open a new connection.
+            connection.reset()
+        print("Error: Couldn't upload to DataBase.")
+        return False
+    finally:
+        if own_connection:
+            connection.close()
+    
+def get_latest_dates(collection, measures)->dict:
+    """
+    This function gets from MongoDB the latest period (date) and the latest revision_date stored for every
+    ticker, measure, periodicity and actual or estimate.
+
+    Parameters:
+    ----------
+    collection : pymongo.collection.Collection
+        The 'bbg.company_financials' collection.
+    measures : list
+        List of BQL functions (measures).
+
+    Returns:
+    -------
+    dict :
+        Returns a dictionary {(ticker, measure, period, actual_or_estimate): (date, revision_date)}.
+    """
+    pipeline = [
+        {'$match':{'_id.measure':{'$in':list(measures)}}},
+        {'$group':{
+            '_id':{'bbg_ticker':'$_id.bbg_ticker','measure':'$_id.measure','period':'$_id.period',
+                   'actual_or_estimate':'$_id.actual_or_estimate'},
+            'date':{'$max':'$_id.date'},
+            'revision_date':{'$max':'$_id.revision_date'},
+        }},
+    ]
+    dict_latest = {}
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        key = doc['_id']
+        dict_latest[(key['bbg_ticker'],key['measure'],key['period'],key['actual_or_estimate'])] = (doc['date'],doc['revision_date'])
+    return dict_latest
+
+def last_reported_period_end(type_period, today)->datetime.datetime:
+    """
+    This function returns the end of the last period that has already finished, so its actual value may
+    have been reported. The end of last year for 'A' and the end of last quarter for 'Q'.
+
+    Parameters:
+    ----------
+    type_period : str
+        'A' for annual or 'Q' for quarter.
+    today : datetime.datetime
+        Reference date.
+
+    Returns:
+    -------
+    datetime.datetime :
+        Returns the date the period ended.
+    """
+    if type_period == 'A':
+        return datetime.datetime(today.year - 1, 12, 31)
+    quarter_start = datetime.datetime(today.year, 3*((today.month - 1)//3) + 1, 1)
+    return quarter_start - datetime.timedelta(days=1)
+
+
+class IncrementalState:
+    """
+    Keeps on disk the last day every ticker was fetched for each measure, periodicity, actual or estimate
+    and source, used by the incremental mode to decide which tickers have to be requested again.
+
+    Parameters:
+    ----------
+    path : str
+        JSON file where the state is stored.
+    """
+    def __init__(self, path='incremental_state.json'):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    @staticmethod
+    def unit(measure, type_period, e_or_a, source)->str:
+        return f'{measure}|{type_period}|{e_or_a}|{source}'
+
+    def last_fetched(self, unit, ticker):
+        """
+        Returns the last day the ticker was fetched for the unit, or None if it never was.
+        """
+        day = self.state.get(unit, {}).get(ticker)
+        return datetime.datetime.strptime(day, '%Y-%m-%d') if day else None
+
+    def mark_fetched(self, unit, tickers, day):
+        dict_unit = self.state.setdefault(unit, {})
+        for ticker in tickers:
+            dict_unit[ticker] = day.strftime('%Y-%m-%d')
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+def split_stale_tickers(tickers, batch, e_or_a, source, dict_latest, state, today, max_age_days=7, active_days=7)->tuple:
+    """
+    This function splits the tickers of a request in the ones that may have changed since they were last
+    fetched ("stale") and the ones that can be skipped in this run ("fresh").
+
+    A ticker is stale if it was never fetched or was last fetched more than max_age_days ago. Besides that,
+    for actuals it is stale while the last finished period isn't stored yet, and for estimates it is stale
+    while it has revisions in the last active_days (tickers being revised are refreshed every day).
+    A ticker is stale for the request if it is stale for any measure of the batch.
+
+    Parameters:
+    ----------
+    tickers : list
+        List of tickers of the request.
+    batch : list
+        List of (bql_function, period) tuples of the request.
+    e_or_a : str
+        'A' for actuals or 'E' for estimates.
+    source : str
+        Source of the request.
+    dict_latest : dict
+        Latest dates stored in MongoDB, see get_latest_dates.
+    state : IncrementalState
+        Last day each ticker was fetched.
+    today : datetime.datetime
+        Reference date.
+    max_age_days : int
+        Maximum number of days a ticker goes without being fetched.
+    active_days : int
+        Estimates revised in this number of days are always fetched.
+
+    Returns:
+    -------
+    tuple :
+        Returns (list of stale tickers, list of fresh tickers).
+    """
+    stale, fresh = [], []
+    for ticker in tickers:
+        is_stale = False
+        for measure, type_period in batch:
+            last_fetched = state.last_fetched(IncrementalState.unit(measure, type_period, e_or_a, source), ticker)
+            if last_fetched is None or (today - last_fetched).days > max_age_days:
+                is_stale = True
+                break
+            date, revision_date = dict_latest.get((ticker, measure, type_period, e_or_a), (None, None))
+            if e_or_a == 'A':
+                if date is None or date < last_reported_period_end(type_period, today):
+                    is_stale = True
+                    break
+            else:
+                if revision_date is not None and (today - revision_date).days <= active_days:
+                    is_stale = True
+                    break
+        if is_stale:
+            stale.append(ticker)
+        else:
+            fresh.append(ticker)
+    return stale, fresh
+
+def periods_to_dates(periods)->pd.Series:
+    """
+    This function converts a column of bloomberg periods (e.g. '2025 A', '2025 Q3') to the date where
+    each period ends, converting each distinct period only once.
+
+    Parameters:
+    ----------
+    periods : pandas.Series
+        Column with the periods.
+
+    Returns:
+    -------
+    pandas.Series :
+        Returns a column with the dates.
+    """
+    dict_dates = {period:period_to_date(period) for period in periods.unique()}
+    return periods.map(dict_dates)
+
+def period_to_date(period):
+    year = int(period.split()[0])
+    if 'A' in period:
+        date = datetime.datetime(year,12,31)
+    if 'Q' in period:
+        quarter = int(period.split()[-1][-1:])
+        month = quarter*3
+        date = datetime.datetime(year,month,1)
+        date = date + relativedelta(day = 31)
+
+    return date
+
+# Measures (BQL functions), periodicities, types of value (estimate or actual) and sources of each type
+# that are requested from bloomberg.
+BQL_FUNCTIONS = ['IS_EPS','IS_COMP_EPS_ADJUSTED','SALES_REV_TURN',
+                 'IS_COMP_SALES','EBITDA','IS_COMPARABLE_EBITDA',
+                 'IS_COMPARABLE_EBIT','CF_CAP_EXPEND_PRPTY_ADD','IS_OPER_INC',
+                 'IS_OPERATING_EXPN','IS_TOT_OPER_EXP','GROSS_PROFIT',
+                 'CB_IS_ADJUSTED_OPEX','IS_AVG_NUM_SH_FOR_EPS','IS_SH_FOR_DILUTED_EPS',
+                 'CF_FREE_CASH_FLOW']
+PERIODS = ['A','Q']
+ACTUAL_OR_ESTIMATE = ['E','A']
+SOURCES = {'E':['BROKERS_ALL','BST','cmpy','cmpy_low','cmpy_high'], 'A':['cmpy']}
+
+def main(backend=None, rebuild_fingerprints=False, full=False, use_cache=True, resume=False,
+         report_dir='run_reports', prometheus_path=None, stream_block_rows=None, backfill_years=5,
+         measures=None, sources=None, periods=None, actual_or_estimate=None, tickers=None, dry_run=False,
+         excel_timeout=120, connection=None, record_dir=None, state_dir=None, max_in_flight=4, max_retries=2,
+         request_timeout=None, min_request_timeout=60):
+    """
+    Gets the financials of every ticker in use from bloomberg and uploads them to MongoDB.
+
+    Parameters:
+    ----------
+    backend : BQLBackend
+        Backend that runs the BQL requests. Defaults to a XlwingsBackend, created when the first request
+        that isn't in the BQL cache is sent (excel isn't opened if every response is in the cache).
+    rebuild_fingerprints : bool
+        If True the fingerprints of the uploaded documents are rebuilt from the collection before the run.
+    full : bool
+        If True every ticker is requested. Otherwise only the tickers that may have changed since they
+        were last fetched are (see split_stale_tickers).
+    use_cache : bool
+        If True the responses of the BQL requests are kept in a local cache for 12 hours, so a rerun
+        doesn't ask bloomberg again.
+    resume : bool
+        If True the units already uploaded by the previous run (see RunJournal) are skipped.
+    report_dir : str
+        Folder where the report with the time of every stage of the run is written.
+    prometheus_path : str
+        If passed, the summary of the report is also written to this file in the Prometheus text format.
+    stream_block_rows : int
+        If passed, the responses are read, converted and uploaded in blocks of this number of rows, so the
+        memory used doesn't grow with the size of the requests. The BQL cache isn't used in this mode,
+        since it keeps whole responses.
+    backfill_years : int
+        Tickers added to the universe since the previous run are requested on their own, starting this
+        number of years ago.
+    measures, sources, periods, actual_or_estimate : list
+        If passed, only these BQL functions, sources, periodicities ('A', 'Q') and types of value ('E', 'A')
+        are requested. By default all of BQL_FUNCTIONS, SOURCES, PERIODS and ACTUAL_OR_ESTIMATE are.
+    tickers : list
+        If passed, only these tickers are requested, every one of them (as in full), instead of the
+        universe of tickers in use.
+    dry_run : bool
+        If True the requests that would be run are printed and nothing is requested or uploaded.
+        Neither excel nor xlwings are loaded.
+    excel_timeout : float
+        Maximum number of seconds to wait for excel to be ready.
+    connection : MongoConnection
+        Connection to the database used for the whole run. Defaults to a MongoConnection to 'PROD'.
+    record_dir : str
+        If passed, the responses of the BQL requests are also saved to this folder (see RecordingBackend),
+        to be replayed later with ReplayBackend.
+    state_dir : str
+        Folder of the files kept between runs (incremental state, journal, batch sizes, latencies,
+        fingerprints and ticker universe). Defaults to the current folder, or to a 'state' folder inside
+        the recordings when the backend is a ReplayBackend, so a replay doesn't change the state of the
+        real runs. A replay also needs a connection to a database other than 'PROD' and doesn't use the
+        BQL cache.
+    max_in_flight : int
+        Maximum number of BQL requests running at the same time.
+    max_retries : int
+        Number of times a request that failed or timed out is tried again (requests big enough are
+        split in two instead).
+    request_timeout : float
+        Seconds after which a request is cancelled. If None it comes from the times of the previous
+        requests of the same source (see RequestLatencyHistory).
+    min_request_timeout : float
+        Minimum timeout in seconds when it comes from the times of the previous requests.
+    """
+
+    # Supressing warnings
+    warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+    warnings.simplefilter(action ='ignore', category = FutureWarning)
+
+    replay = isinstance(backend, ReplayBackend)
+    if replay and (connection is None or connection.environment == 'PROD'):
+        raise ValueError('Replaying recorded responses needs a connection to a database other than PROD.')
+    if state_dir is None:
+        state_dir = os.path.join(backend.directory, 'state') if replay else ''
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+
+    # Creating a connection to our mongoDB database, used for the whole run.
+    if connection is None:
+        tipo_bd = 'PROD'
+        connection = MongoConnection(tipo_bd)
+
+    if tickers is None:
+        # Getting the sorted list of equity tickers from mongoDB, only read again if it changed or is a day old.
+        universe = TickerUniverse(os.path.join(state_dir,'ticker_universe.json'), ttl_seconds=24*3600)
+        list_tickers = universe.tickers(connection.open())
+        # Tickers added since the previous run are backfilled in their own requests.
+        new_tickers, removed_tickers = universe.diff()
+        if new_tickers or removed_tickers:
+            print(f'{len(new_tickers)} tickers added and {len(removed_tickers)} removed since the previous run.')
+        set_new_tickers = set(new_tickers)
+        list_tickers = [ticker for ticker in list_tickers if ticker not in set_new_tickers]
+    else:
+        # Refreshing only the tickers that were asked for.
+        universe = None
+        list_tickers = sorted(tickers)
+        new_tickers = []
+        full = True
+
+    # Passing the periodicity variables that will be used in fuctions in the loop.
+    periods = [period for period in PERIODS if periods is None or period in periods]
+    # Passing the type of value variables that will be used in fuctions in the loop.
+    actual_or_estimate = [e_or_a for e_or_a in ACTUAL_OR_ESTIMATE if actual_or_estimate is None or e_or_a in actual_or_estimate]
+    # Passing the BLQ fuctions that will be used for the BQLs queries in the loop.
+    bql_functions = [func for func in BQL_FUNCTIONS if measures is None or func in measures]
+    # Passing time variables from which we want data from.
+    years_lagging = 1
+    start = f'{datetime.datetime.today().year + years_lagging}-01-01'
+    years_ahead = 2
+    end = f'{datetime.datetime.today().year + years_ahead}-12-31'
+    start_backfill = f'{datetime.datetime.today().year - backfill_years}-01-01'
+    # Passing fields variables from with we want the values from. 
+    flds = ['PERIOD','FIRM_NAME','REVISION_DATE','CURRENCY','VALUE']
+    
+    # In the incremental mode only the tickers that may have changed since they were last fetched are requested.
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    state = IncrementalState(os.path.join(state_dir,'incremental_state.json'))
+
+    # Journal of what was fetched and uploaded, so the run can be resumed if it stops in the middle.
+    journal = RunJournal(os.path.join(state_dir,'run_journal.jsonl'), resume=resume, read_only=dry_run)
+    planned_jobs = journal.planned_jobs()
+    if journal.resumed:
+        print(f'Resuming: {len(journal.uploaded)} units already uploaded.')
+    elif resume:
+        print('The previous run finished or is from another day, starting a new run.')
+
+    # The tickers are split in requests of the size that worked best for each function and source.
+    sizer = AdaptiveBatchSizer(os.path.join(state_dir,'bql_batch_sizes.json'))
+
+    if planned_jobs is not None:
+        # The run being resumed is done with the requests it planned, the batches of a new plan could be different.
+        batches = journal.batches
+    else:
+        # Grouping the measures so several of them go in the same BQL request.
+        max_fields_per_request = 60
+        batches = plan_bql_batches(bql_functions, periods, len(flds), max_fields_per_request)
+        if not full:
+            dict_latest = get_latest_dates(connection.collection('gestao','bbg.company_financials'), bql_functions)
+        # Planning every request that will be sent to bloomberg.
+        planned_jobs = []
+        for batch_index, batch in enumerate(batches):
+            for e_or_a in actual_or_estimate:
+                # Passing the kind of source we want the script to get.
+                for source in [source for source in SOURCES[e_or_a] if sources is None or source in sources]:
+                    if full:
+                        tickers_request = list_tickers
+                    else:
+                        tickers_request, _ = split_stale_tickers(list_tickers,batch,e_or_a,source,dict_latest,state,today)
+                    batch_size = sizer.size(AdaptiveBatchSizer.key(batch,e_or_a,source))
+                    # The new tickers go in requests of their own, with the longer window of the backfill.
+                    for is_backfill, tickers_group in [(False,tickers_request),(True,new_tickers)]:
+                        for tickers_index, tickers in enumerate(separa_lista(tickers_group,batch_size)):
+                            tickers_id = ('backfill', tickers_index) if is_backfill else (tickers_index,)
+                            planned_jobs.append(((tickers_id, batch_index, e_or_a, source), tickers))
+        if not dry_run:
+            journal.record_plan(batches, planned_jobs)
+
+    # Creating every request that will be sent to bloomberg.
+    jobs = []
+    jobs_tickers = {}
+    for job_id, tickers in planned_jobs:
+        tickers_id, batch_index, e_or_a, source = job_id
+        batch = batches[batch_index]
+        units = [RunJournal.unit(tickers,func,e_or_a,source,type_period) for func, type_period in batch]
+        if all(unit in journal.uploaded for unit in units):
+            # Already uploaded by the run being resumed.
+            continue
+        # The backfill requests have the longer window.
+        start_request = start_backfill if tickers_id[0] == 'backfill' else start
+        jobs.append((job_id, create_batch_request(start_request,end,batch,tickers,source,e_or_a,flds)))
+        jobs_tickers[job_id] = tickers
+
+    def split_failed_request(job_id, request, error):
+        # Requests that time out or fail are split in two halves instead of being tried again as they are.
+        tickers_id, batch_index, e_or_a, source = job_id
+        if len(request.tickers) <= sizer.min_size:
+            return None
+        # Backfill requests have a wider window than the daily ones, their failures are kept out of the sizer.
+        if tickers_id[0] != 'backfill':
+            sizer.record_failure(AdaptiveBatchSizer.key(batches[batch_index],e_or_a,source), len(request.tickers))
+        half = len(request.tickers) // 2
+        new_jobs = []
+        for i, tickers in enumerate([request.tickers[:half], request.tickers[half:]]):
+            new_job_id = (tickers_id + (i,), batch_index, e_or_a, source)
+            jobs_tickers[new_job_id] = tickers
+            new_jobs.append((new_job_id, BQLRequest(tickers, request.functions)))
+        # A resumed run sends the halves instead of the request that was split.
+        journal.record_split(job_id, [(new_job_id, new_request.tickers) for new_job_id, new_request in new_jobs])
+        print(f'Request {job_id} failed ({error}), splitting it in two.')
+        return new_jobs
+    print(f'{len(jobs)} BQL requests to run.')
+    if dry_run:
+        df_plan = pd.DataFrame([{'actual_or_estimate':job_id[2], 'source':job_id[3], 'backfill':job_id[0][0] == 'backfill',
+                                 'measures':len(batches[job_id[1]]), 'tickers':len(request.tickers)}
+                                for job_id, request in jobs])
+        if len(df_plan):
+            print(df_plan.groupby(['actual_or_estimate','source','backfill']).agg(
+                requests=('tickers','size'), tickers=('tickers','sum'), measures=('measures','sum')))
+        connection.close()
+        return
+
+    use_cache = use_cache and stream_block_rows is None and not replay
+    if use_cache:
+        cache = BQLResponseCache('bql_cache', ttl_seconds=12*3600)
+    if backend is None:
+        # Excel is only opened if some request isn't in the BQL cache, a rerun within the TTL doesn't need it.
+        excel_launched = not use_cache or not all(cache.contains(request) for _, request in jobs)
+        if excel_launched:
+            # Opening an excel instance for the addins to load, while the rest of the run is prepared.
+            launch_excel()
+        def start_excel_backend():
+            if not excel_launched:
+                launch_excel()
+            # Waiting for excel to be ready instead of a fixed time.
+            wait_excel_ready(timeout=excel_timeout)
+            return XlwingsBackend()
+        backend = LazyBackend(start_excel_backend)
+    if record_dir is not None:
+        backend = RecordingBackend(backend, record_dir)
+    if use_cache:
+        backend = CachedBackend(backend, cache)
+
+    # Keeping several requests running at the same time and uploading each response as soon as it arrives.
+    # The time each request takes is kept between runs to set the polling and the timeouts.
+    latency_history = RequestLatencyHistory(path=os.path.join(state_dir,'bql_latency_history.json'), min_timeout=min_request_timeout)
+    scheduler = BQLScheduler(backend, max_in_flight=max_in_flight, timeout_seconds=request_timeout, max_retries=max_retries,
+                             latency_history=latency_history, latency_key=lambda job_id: job_id[3],
+                             on_failure=split_failed_request, block_rows=stream_block_rows)
+    # Only the documents that changed since the last run are uploaded.
+    fingerprints = FingerprintStore(os.path.join(state_dir,'company_financials_fingerprints.npz'))
+    if rebuild_fingerprints:
+        fingerprints.rebuild_from_collection(connection.collection('gestao','bbg.company_financials'))
+    fetched_jobs = []
+    failed_backfill = set()
+    # The responses are uploaded by a background thread while the next requests run.
+    # The documents are written by several threads in unordered bulk operations. The writes are upserts that
+    # can be run again, so an acknowledgement of the primary is enough.
+    writer = MongoBulkWriter(connection, n_writers=4, batch_size=1000, write_concern={'w':1}, fingerprints=fingerprints)
+    pipeline = UploadPipeline(connection=connection, max_queue=8, fingerprints=fingerprints, journal=journal, writer=writer)
+    finished = False
+    try:
+        with writer, pipeline:
+            for job_id, df, error in tqdm(scheduler.run(jobs), total=len(jobs)):
+                _, batch_index, e_or_a, source = job_id
+                batch = batches[batch_index]
+                is_backfill = job_id[0][0] == 'backfill'
+                if error is None:
+                    # Without streaming the whole response is a single block.
+                    blocks = [df] if stream_block_rows is None else df
+                    rows = {}
+                    try:
+                        for df_block, is_last in iter_last(blocks):
+                            dict_dfs = process_batch_response(df_block,batch,source,e_or_a,len(flds))
+                            for (func, type_period), df_func in dict_dfs.items():
+                                unit = RunJournal.unit(jobs_tickers[job_id],func,e_or_a,source,type_period)
+                                rows[unit] = rows.get(unit, 0) + len(df_func)
+                                # The unit is only recorded as uploaded with its last block.
+                                pipeline.put(func, df_func, unit, complete=is_last)
+                    except Exception as e:
+                        if stream_block_rows is None:
+                            raise
+                        # The response stopped in the middle, the blocks already uploaded are kept but the units
+                        # aren't recorded as uploaded.
+                        traceback.print_exc()
+                        scheduler.stream_failed(job_id)
+                        error = e
+                if error is not None:
+                    print(f'Request {job_id} failed: {error}')
+                    for func, _ in batch:
+                        pipeline.mark_failed(func)
+                    if is_backfill:
+                        failed_backfill.update(jobs_tickers[job_id])
+                    continue
+                # The backfill requests have a longer window, their times don't tell how big the others can be.
+                # Responses from the cache have no time (see BQLScheduler.cache_hits).
+                if not is_backfill and job_id in scheduler.job_latencies:
+                    sizer.record_success(AdaptiveBatchSizer.key(batch,e_or_a,source), len(jobs_tickers[job_id]), scheduler.job_latencies[job_id])
+                for unit, n_rows in rows.items():
+                    journal.record('fetch', unit, rows=n_rows)
+                fetched_jobs.append(job_id)
+        finished = True
+    finally:
+        # What was done is saved even if the run stops in the middle, so the next run doesn't do it again.
+        already_uploaded = pipeline.already_uploaded
+        # Recording the tickers that were fetched, only for functions that were completely uploaded.
+        for job_id in fetched_jobs:
+            _, batch_index, e_or_a, source = job_id
+            for func, type_period in batches[batch_index]:
+                if already_uploaded.get(func, [False])[0]:
+                    state.mark_fetched(IncrementalState.unit(func,type_period,e_or_a,source), jobs_tickers[job_id], today)
+                elif job_id[0][0] == 'backfill':
+                    failed_backfill.update(jobs_tickers[job_id])
+        state.save()
+        if universe is not None and finished:
+            # The new tickers that failed are backfilled again in the next run.
+            universe.mark_backfilled(set(new_tickers) - failed_backfill)
+            universe.save()
+        if finished:
+            # A run that finished isn't resumed.
+            journal.finish()
+        journal.close()
+        fingerprints.save()
+        latency_history.save()
+        sizer.save()
+        # The report is also written when the run stops in the middle, when its times are needed the most.
+        report_path = run_metrics.write_report(report_dir, prometheus_path)
+        print(run_metrics.summary())
+        print(f'Run report written to {report_path}')
+    print(scheduler.report())
+    if use_cache:
+        print(f'BQL cache: {cache.report()}')
+    
+    backend.close()
+    # Closing mongoDb connection.
+    connection.close()
+    print(pd.DataFrame(already_uploaded))
+    
+
+            
+
+def parse_args(argv=None):
+    """
+    Parses the command line. 'run' is the default command, so the script can still be called without one.
+
+        python get_fundamentalist_data4.py run --measures IS_EPS EBITDA --sources cmpy --tickers "VALE3 BZ Equity"
+        python get_fundamentalist_data4.py run --dry-run
+        python get_fundamentalist_data4.py run --replay-dir bql_recordings --environment DEV
+        python get_fundamentalist_data4.py list
+    """
+    parser = argparse.ArgumentParser(description='Gets company financials from bloomberg and uploads them to MongoDB.')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='get the financials from bloomberg and upload them to MongoDB (default)')
+    run_parser.add_argument('--measures', nargs='+', choices=BQL_FUNCTIONS, metavar='MEASURE', help='only request these BQL functions')
+    run_parser.add_argument('--sources', nargs='+', choices=sorted(set(SOURCES['E'] + SOURCES['A'])), help='only request these sources')
+    run_parser.add_argument('--periods', nargs='+', choices=PERIODS, help='only request these periodicities')
+    run_parser.add_argument('--actual-or-estimate', nargs='+', choices=ACTUAL_OR_ESTIMATE, help='only request estimates (E) or actuals (A)')
+    run_parser.add_argument('--tickers', nargs='+', help='only request these bloomberg tickers (all of them, as with --full)')
+    run_parser.add_argument('--dry-run', action='store_true', help="print the requests that would be run, without opening excel or uploading")
+    run_parser.add_argument('--full', action='store_true', help='request every ticker instead of only the ones that may have changed')
+    run_parser.add_argument('--resume', action='store_true', help='continue the previous run, skipping what it already uploaded')
+    run_parser.add_argument('--no-cache', action='store_true', help="don't use the local cache of BQL responses")
+    run_parser.add_argument('--report-dir', default='run_reports', help='folder of the run report with the time of every stage')
+    run_parser.add_argument('--prometheus-file', help='also write the run report in the Prometheus text format to this file')
+    run_parser.add_argument('--backfill-years', type=int, default=5, help='years of history requested for tickers added since the previous run')
+    run_parser.add_argument('--stream-block-rows', type=int, help='read and upload the responses in blocks of this number of rows')
+    run_parser.add_argument('--rebuild-fingerprints', action='store_true', help='rebuild the fingerprints of the uploaded documents from MongoDB')
+    replay_group = run_parser.add_mutually_exclusive_group()
+    replay_group.add_argument('--replay-dir', help='replay the BQL responses recorded in this folder instead of using excel')
+    replay_group.add_argument('--record-dir', help='also save the BQL responses to this folder, to be replayed later')
+    run_parser.add_argument('--environment', default='PROD', help='environment of the MongoDB database (a replay needs one other than PROD)')
+    run_parser.add_argument('--max-in-flight', type=int, default=4, help='maximum number of BQL requests running at the same time')
+    run_parser.add_argument('--max-retries', type=int, default=2, help='times a failed or timed out request is tried again')
+    run_parser.add_argument('--request-timeout', type=float, help='seconds before a request is cancelled (default: from the times of the previous requests)')
+    run_parser.add_argument('--min-request-timeout', type=float, default=60, help='minimum timeout when it comes from the times of the previous requests')
+    run_parser.add_argument('--excel-timeout', type=float, default=120, help='maximum seconds to wait for excel to be ready')
+    run_parser.add_argument('--pause', action='store_true', help='wait for ENTER before closing, to read the output')
+    subparsers.add_parser('list', help='list the measures, sources and periodicities that can be requested')
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h','--help'):
+        argv = ['run'] + argv
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
     # Supressing warnings
     warnings.simplefilter(action = 'ignore', category = pd.errors.PerformanceWarning)
+    args = parse_args()
+    if args.command == 'list':
+        print('Measures:', ' '.join(BQL_FUNCTIONS))
+        for e_or_a in ACTUAL_OR_ESTIMATE:
+            print(f'Sources ({e_or_a}):', ' '.join(SOURCES[e_or_a]))
+        print('Periods:', ' '.join(PERIODS))
+        sys.exit(0)
+    exit_code = 0
     try:
         print('Getting company financials (both estimates and actuals) from multiple analyst sources from bloomblerg')
         time_init = datetime.datetime.today()
-        main()
+        # Replaying recorded responses (matched ignoring the dates of the window) instead of using excel.
+        backend = ReplayBackend(args.replay_dir) if args.replay_dir else None
+        main(backend=backend, connection=MongoConnection(args.environment), rebuild_fingerprints=args.rebuild_fingerprints, full=args.full, use_cache=not args.no_cache,
+             resume=args.resume, report_dir=args.report_dir, prometheus_path=args.prometheus_file,
+             stream_block_rows=args.stream_block_rows, backfill_years=args.backfill_years,
+             measures=args.measures, sources=args.sources, periods=args.periods,
+             actual_or_estimate=args.actual_or_estimate, tickers=args.tickers, dry_run=args.dry_run,
+             excel_timeout=args.excel_timeout, record_dir=args.record_dir, max_in_flight=args.max_in_flight,
+             max_retries=args.max_retries, request_timeout=args.request_timeout,
+             min_request_timeout=args.min_request_timeout)
         time_end = datetime.datetime.today()
         run_time = time_end - time_init
         print(f'Script took {run_time} to run')
     except Exception as e:
         traceback.print_exc()
         print(e)
+        exit_code = 1
 
-    input('Press ENTER to quit.')
+    if args.pause:
+        input('Press ENTER to quit.')
+    sys.exit(exit_code)